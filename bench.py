@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import copy, json, math, os, platform, resource, subprocess, tempfile, time, tracemalloc
+from argparse import ArgumentParser
+from functools import partial
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from pipeline import add_arguments, load_data, INTERACTION_COLUMNS, SONG_COLUMNS, USER_COLUMNS
+from processing import process_training, process_songs, process_users, construct_datapoints
+from dataset import MRSDataset, BucketBatchSampler, DedupCollate, collate, collate_users
+from model import DTNMR
+from recommend import Recommender
+from utils.misc import get
+from utils.nn import Indexed
+from utils import fastmath
+from utils.fastmath import PRECISIONS, autocast
+from utils.synthetic import generate
+
+"""
+Benchmarks of the hot paths on synthetic data (see utils.synthetic): csv loading, processing,
+dataset items and batches, DTNMR forward and backward passes, and top-K scoring. Results are
+written as JSON, along with the versions and parameters they were measured with, so that runs
+of different commits can be compared (--baseline).
+
+Times are the best of --repeats runs. Memory is the peak of the Python and numpy allocations
+(tracemalloc) during an extra, untimed, run of the data stages.
+"""
+
+BENCHES = ('get', 'processing', 'dataset', 'model', 'ranking')
+
+def timed(fn, repeats=3):
+    """Runs fn repeats times, returns its last result and its best and mean times (seconds)."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, {'seconds': min(times), 'mean_seconds': float(np.mean(times))}
+
+def peak_memory(fn):
+    """Peak memory (MB) allocated through Python while running fn, numpy arrays included."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+def measure(fn, repeats=3, memory=True):
+    result, metrics = timed(fn, repeats)
+    if memory:
+        metrics['peak_mb'] = peak_memory(fn)
+    return result, metrics
+
+
+def bench_get(db, repeats):
+    """csv loading (utils.misc.get) of each file, returns the loaded data along."""
+    results, loaded = {}, {}
+    for name, columns in (('train', INTERACTION_COLUMNS), ('test', INTERACTION_COLUMNS),
+        ('songs', SONG_COLUMNS), ('members', USER_COLUMNS)):
+        fp = os.path.join(db, name + '.csv')
+        (_, loaded[name]), metrics = measure(lambda: get(fp, columns=columns,
+            categorical=columns), repeats)
+        rows = len(loaded[name][columns[0]])
+        results['get/' + name] = dict(metrics, rows=rows, rows_per_s=rows / metrics['seconds'])
+    return results, loaded
+
+def bench_processing(loaded, args):
+    """The stages of processing.py, on the loaded csv files."""
+    results = {}
+    (popularity, most_popular), results['processing/training'] = measure(
+        lambda: process_training(loaded['train']), args.repeats)
+    (songs, *_), results['processing/songs'] = measure(
+        lambda: process_songs(loaded['songs'], popularity, most_popular, args.top), args.repeats)
+    (users, *_), results['processing/users'] = measure(
+        lambda: process_users(loaded['members']), args.repeats)
+    (points, *_), metrics = measure(lambda: construct_datapoints(loaded['train'], users, songs,
+        args.min_playlist_len, args.max_playlist_len), args.repeats)
+    results['processing/datapoints'] = dict(metrics, points=len(points))
+    return results
+
+def sample(dataset, n, seed=0):
+    """Indices of n random points of the dataset with a known playlist."""
+    indices = np.flatnonzero(np.asarray(dataset.user_song.positions) > 0)
+    return np.random.default_rng(seed).choice(indices, min(n, len(indices)), replace=False)
+
+def collate_fn(data, args, dtype=torch.float32):
+    if args.dedup:
+        return DedupCollate(data.song_table, args.sparse, dtype)
+    return partial(collate, dtype=dtype)
+
+def bench_dataset(data, args):
+    """MRSDataset items per second and collated batches per second."""
+    dataset = MRSDataset(data.train_points, data.train_playlist, data.users, data.song_table,
+        data.encode_user, data.encode_behavior, args.subset_size, args.long_term_len,
+        sparse=args.sparse, dedup=args.dedup)
+    indices = sample(dataset, args.batches * args.batch_size).tolist()
+    _, metrics = measure(lambda: [dataset[i] for i in indices], args.repeats)
+    results = {'dataset/getitem': dict(metrics, items=len(indices),
+        items_per_s=len(indices) / metrics['seconds'])}
+
+    loader = DataLoader(dataset, collate_fn=collate_fn(data, args), num_workers=args.num_workers,
+        batch_sampler=BucketBatchSampler(dataset.lengths(), args.batch_size, seed=0))
+    def batches():
+        for n, _ in zip(range(args.batches), loader):
+            pass
+        return n + 1
+    n, metrics = measure(batches, args.repeats, memory=args.num_workers == 0)
+    results['dataset/batches'] = dict(metrics, batches=n, batches_per_s=n / metrics['seconds'])
+    return results
+
+def mfc_songs(batch):
+    """Number of songs embedded by MFC for the batch, padding steps included."""
+    _, playlist, _, subset, _ = batch
+    if isinstance(subset, Indexed):
+        return subset.songs.shape[0]
+    return math.prod(playlist.shape[:2]) + math.prod(subset.shape[:2])
+
+def train_steps(model, batches, dtype=torch.float32, repeats=3):
+    """Times the forward pass and loss, and the backward pass, of each batch (seconds)."""
+    criterion = torch.nn.CrossEntropyLoss()
+    forward, backward = [], []
+    for i in range(repeats + 1): # the first pass is a warm-up, e.g. for torch.compile
+        for x in batches if i else batches[:1]:
+            start = time.perf_counter()
+            with autocast(dtype):
+                y_hat = model(*x)
+                loss = criterion(y_hat, torch.zeros(y_hat.shape[0], dtype=torch.long))
+            middle = time.perf_counter()
+            loss.backward()
+            model.zero_grad()
+            if i:
+                forward.append(middle - start)
+                backward.append(time.perf_counter() - middle)
+    return forward, backward
+
+def bench_model(data, args):
+    """
+    DTNMR forward and backward passes per batch, for each subset size and playlist length, and
+    each precision (see utils.fastmath), compiled or not: the speedup is relative to float32.
+    """
+    results = {}
+    sizes = data.sizes()
+    for subset_size in args.subset_sizes:
+        for length in args.seq_lens:
+            reference = DTNMR(**sizes, st_playlist_len=args.short_term_len,
+                emb_size=args.emb_size, sparse=args.sparse)
+            dataset = MRSDataset(data.train_points, data.train_playlist, data.users,
+                data.song_table, data.encode_user, data.encode_behavior, subset_size, length,
+                sparse=args.sparse, dedup=args.dedup)
+            indices = sample(dataset, args.batches * args.batch_size)
+            items = [dataset.__getitems__(indices[i:i + args.batch_size].tolist())
+                for i in range(0, len(indices), args.batch_size)]
+
+            name = 'model/subset={}/len={}'.format(subset_size, length)
+            for precision, compiled in [(p, False) for p in args.precisions] \
+                + [(p, True) for p in args.precisions if args.compile]:
+                dtype = PRECISIONS[precision]
+                batches = [collate_fn(data, args, dtype)(batch) for batch in items]
+                model = copy.deepcopy(reference)
+                if compiled:
+                    fastmath.compile(model)
+                forward, backward = train_steps(model, batches, dtype, args.repeats)
+                points = sum(len(x[-1]) for x in batches)
+                key = name if precision == 'fp32' and not compiled else \
+                    '{}/{}{}'.format(name, precision, '+compile' if compiled else '')
+                results[key] = {
+                    'forward_ms': float(np.median(forward)) * 1000,
+                    'backward_ms': float(np.median(backward)) * 1000,
+                    'points_per_s': points * args.repeats / (sum(forward) + sum(backward)),
+                    'seq_len': int(max(int(x[-1].max()) for x in batches)),
+                    'mfc_songs_per_batch': float(np.mean([mfc_songs(x) for x in batches])),
+                }
+                if name in results and key != name:
+                    results[key]['speedup'] = results[key]['points_per_s'] \
+                        / results[name]['points_per_s']
+    return results
+
+def bench_ranking(data, args):
+    """Catalogue embedding and top-K recommendation of training users, played songs excluded."""
+    model = DTNMR(**data.sizes(), st_playlist_len=args.short_term_len, emb_size=args.emb_size,
+        sparse=args.sparse)
+    recommender, metrics = measure(lambda: Recommender(model, data.song_table), args.repeats,
+        memory=False)
+    results = {'ranking/embed': dict(metrics, songs=len(data.song_table),
+        songs_per_s=len(data.song_table) / metrics['seconds'])}
+
+    dataset = MRSDataset(data.train_points, data.train_playlist, data.users, data.song_table,
+        data.encode_user, data.encode_behavior, 1, args.long_term_len, sparse=args.sparse)
+    points = [dataset.user_song.rows(i) for i in sample(dataset, args.batches * args.batch_size)]
+    batches = []
+    for i in range(0, len(points), args.batch_size):
+        rows = points[i:i + args.batch_size]
+        batches.append((collate_users([dataset.encode(user, position)
+            for user, _, position in rows]), [dataset.playlist.songs[
+            dataset.playlist.offsets[user]:dataset.playlist.offsets[user] + position]
+            for user, _, position in rows]))
+    _, metrics = measure(lambda: [recommender.recommend(*batch, k=args.k, exclude=exclude)
+        for batch, exclude in batches], args.repeats, memory=False)
+    results['ranking/top-k'] = dict(metrics, users=len(points),
+        users_per_s=len(points) / metrics['seconds'])
+    return results
+
+
+def metadata(args):
+    """Versions, machine and parameters of the run."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'numpy': np.__version__,
+        'torch': torch.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(),
+        'threads': torch.get_num_threads(),
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'params': {k: v for k, v in vars(args).items() if k not in ('baseline', 'output')}}
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the regressions of results against the baseline results: times (seconds, *_ms)
+    and memory (peak_mb) which grew, throughputs (*_per_s) which dropped, by more than the
+    tolerance ratio.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old or not isinstance(value, float):
+                continue
+            if metric.endswith('_per_s'):
+                change = old / value - 1
+            elif metric in ('seconds', 'peak_mb') or metric.endswith('_ms'):
+                change = value / old - 1
+            else:
+                continue
+            if change > tolerance:
+                regressions.append('{} {}: {:.4g} -> {:.4g} ({:+.0%})'.format(name, metric, old,
+                    value, change if not metric.endswith('_per_s') else value / old - 1))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks the hot paths on synthetic data.')
+
+    # ~ data processing, --db and --cache are set to directories of --work-dir
+    add_arguments(parser)
+
+    # ~ synthetic data
+    parser.add_argument('--users', metavar='NB', type=int, default=2000,
+        help='Number of synthetic users.')
+    parser.add_argument('--songs', metavar='NB', type=int, default=20000,
+        help='Number of songs of the synthetic catalogue.')
+    parser.add_argument('--playlist-len', metavar='NB', type=int, default=50,
+        help='Mean number of songs per synthetic user.')
+    parser.add_argument('--work-dir', metavar='PATH', type=str, default=None,
+        help='Directory of the synthetic csv files and cache, a temporary one by default.')
+
+    # ~ bench params
+    parser.add_argument('--benches', choices=BENCHES, nargs='+', default=BENCHES,
+        help='Benchmarks to run.')
+    parser.add_argument('--repeats', metavar='NB', type=int, default=3,
+        help='Number of timed runs of each benchmark.')
+    parser.add_argument('--batches', metavar='NB', type=int, default=10,
+        help='Number of batches of the dataset, model and ranking benchmarks.')
+    parser.add_argument('--batch-size', metavar='NB', type=int, default=64,
+        help='Number of points per batch.')
+    parser.add_argument('--subset-size', metavar='NB', type=int, default=5,
+        help='Number of songs rated per point in the dataset benchmark.')
+    parser.add_argument('--subset-sizes', metavar='NB', type=int, nargs='+', default=[5, 20],
+        help='Subset sizes of the model benchmark.')
+    parser.add_argument('--seq-lens', metavar='NB', type=int, nargs='+', default=[5, 20],
+        help='Long-term playlist lengths of the model benchmark.')
+    parser.add_argument('--short-term-len', metavar='NB', type=int, default=10,
+        help='Length of a short-term user playlist.')
+    parser.add_argument('--long-term-len', metavar='NB', type=int, default=20,
+        help='Length of a long-term user playlist.')
+    parser.add_argument('--emb-size', metavar='NB', type=int, default=32,
+        help='Size of the user and song embeddings.')
+    parser.add_argument('--sparse', action='store_true', default=False,
+        help='Add flag to benchmark sparse encodings instead of dense ones.')
+    parser.add_argument('--precisions', choices=PRECISIONS, nargs='+', default=['fp32'],
+        help='Compute dtypes of the model benchmark, the speedup is relative to fp32.')
+    parser.add_argument('--compile', action='store_true', default=False,
+        help='Add flag to also benchmark the models compiled with torch.compile.')
+    parser.add_argument('--dedup', action='store_true', default=False,
+        help='Add flag to embed the distinct songs of each batch once, see dataset.DedupCollate.')
+    parser.add_argument('--num-workers', metavar='NB', type=int, default=0,
+        help='Number of DataLoader worker processes of the batches benchmark.')
+    parser.add_argument('--k', metavar='NB', type=int, default=10,
+        help='Number of songs recommended per user in the ranking benchmark.')
+    parser.add_argument('--output', metavar='PATH', type=str, default='bench.json',
+        help='File where the results are written.')
+    parser.add_argument('--baseline', metavar='PATH', type=str, default=None,
+        help='Results of a previous run to compare to, regressions make the command fail.')
+    parser.add_argument('--tolerance', metavar='RATIO', type=float, default=0.1,
+        help='Relative slowdown or memory growth reported as a regression.')
+
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench-')
+    args.db, args.cache = os.path.join(work_dir, 'db'), os.path.join(work_dir, 'cache')
+    if not os.path.isfile(os.path.join(args.db, 'train.csv')):
+        print('generating synthetic data in {}...'.format(args.db))
+        generate(args.db, args.users, args.songs, args.playlist_len)
+
+    results = {}
+    if 'get' in args.benches or 'processing' in args.benches:
+        get_results, loaded = bench_get(args.db, args.repeats)
+        if 'get' in args.benches:
+            results.update(get_results)
+        if 'processing' in args.benches:
+            results.update(bench_processing(loaded, args))
+        del loaded
+    if {'dataset', 'model', 'ranking'} & set(args.benches):
+        data = load_data(args)
+        for name, bench in (('dataset', bench_dataset), ('model', bench_model),
+            ('ranking', bench_ranking)):
+            if name in args.benches:
+                results.update(bench(data, args))
+
+    output = {'meta': metadata(args), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    for name, metrics in results.items():
+        print('{:<32} '.format(name) + ' - '.join('{}={:.4g}'.format(metric, value)
+            for metric, value in metrics.items()))
+    print('results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta']['params'] != output['meta']['params']:
+            print('warning: the baseline was run with other parameters')
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            exit(1)
@@ -0,0 +1,395 @@
+import os
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from utils.dumper import save, load
+from utils.process import factorize
+
+"""
+Columnar storage of the processed data. Entities and playlists are kept as flat integer
+arrays plus offsets (i.e. ragged arrays) and string vocabularies. The classes below expose
+them with the same interface as the dicts built by processing.py, without holding any Python
+object per entry.
+"""
+
+def ragged(lists, dtype):
+    """
+    Flattens lists into (offsets, values) such that lists[i] = values[offsets[i]:offsets[i+1]].
+    """
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(l) for l in lists], out=offsets[1:])
+    values = np.fromiter((x for l in lists for x in l), dtype=dtype, count=offsets[-1])
+    return offsets, values
+
+def vocabulary(values):
+    """Sorted vocabulary array of a set of strings."""
+    return np.array(sorted(values), dtype=str)
+
+
+def extend(vocab, values):
+    """
+    Appends the values missing from vocab at its end, so that the codes of the existing values
+    don't change. Returns the new vocabulary and its {value: code} index.
+    """
+    known = set(vocab.tolist())
+    vocab = np.concatenate([vocab, np.array(sorted(set(values) - known), dtype=str)])
+    return vocab, {v: c for c, v in enumerate(vocab.tolist())}
+
+def encoded(columns, name):
+    """
+    The part of vocabulary `<name>.vocab` the encoders are built from: the whole vocabulary
+    built with the cache. Values added later by ingest.py are left out, so the size of the
+    encodings (and thus of the model inputs) never changes, they are encoded as unknown values.
+    """
+    vocab = columns[name + '.vocab']
+    return vocab[:int(columns[name + '.encoded'])] if name + '.encoded' in columns else vocab
+
+
+class Table(Mapping):
+    """
+    Read-only {id: (feature, ...)} mapping where each feature is the list of values of the entity.
+    Every feature is a ragged array (`<name>.offsets`, `<name>.values`); for categorical
+    features the values are codes into the vocabulary `<name>.vocab`, sorted when the table
+    is saved and extended at the end by `append`.
+    """
+
+    def __init__(self, columns, names):
+        self.columns = columns
+        self.names = names
+        self.ids = columns['ids']
+        self.index = {id: i for i, id in enumerate(self.ids.tolist())}
+
+    @staticmethod
+    def save(fp, header, rows, names, vocabs, **columns):
+        """
+        Parameters
+        ---
+        rows: dict {id: (list of values, ...)}
+            The entities, as returned by processing.process_songs and processing.process_users.
+        names: list of string
+            Name of each feature.
+        vocabs: dict {name: set}
+            Vocabulary of the categorical features, numeric features are left out.
+        columns: dict {name: np.ndarray}
+            Additional columns to save along.
+        """
+        columns['ids'] = np.array(list(rows), dtype=str)
+        for i, name in enumerate(names):
+            lists = [row[i] for row in rows.values()]
+            if name in vocabs:
+                columns[name + '.vocab'] = vocabulary(vocabs[name])
+                index = {v: c for c, v in enumerate(columns[name + '.vocab'].tolist())}
+                lists = [[index[v] for v in l] for l in lists]
+            dtype = np.int32 if name in vocabs else np.float64
+            columns[name + '.offsets'], columns[name + '.values'] = ragged(lists, dtype)
+        save(fp, header, **columns)
+
+    @classmethod
+    def load(cls, fp, header, names):
+        return cls(load(fp, header), names)
+
+    def append(self, fp, header, rows, **columns):
+        """
+        Saves the table with the entities of rows appended at the end, those already in the
+        table are left out. The rows and the vocabulary codes of the existing entities stay the
+        same. Returns the ids of the appended entities.
+
+        Parameters
+        ---
+        rows: dict {id: (list of values, ...)}
+            The entities, see save.
+        columns: dict {name: np.ndarray}
+            Columns to replace, along with the other ones, they must cover the new rows.
+        """
+        rows = {id: row for id, row in rows.items() if id not in self.index}
+        columns = {**self.columns, **columns}
+        columns['ids'] = np.concatenate([self.ids, np.array(list(rows), dtype=str)])
+        for i, name in enumerate(self.names):
+            lists = [row[i] for row in rows.values()]
+            if name + '.vocab' in self.columns:
+                columns.setdefault(name + '.encoded', np.array(len(self.vocab(name))))
+                columns[name + '.vocab'], index = extend(self.vocab(name),
+                    (v for l in lists for v in l))
+                lists = [[index[v] for v in l] for l in lists]
+            offsets, values = self.columns[name + '.offsets'], self.columns[name + '.values']
+            new_offsets, new_values = ragged(lists, values.dtype)
+            columns[name + '.offsets'] = np.concatenate([offsets, offsets[-1] + new_offsets[1:]])
+            columns[name + '.values'] = np.concatenate([values, new_values])
+        save(fp, header, **columns)
+        return list(rows)
+
+    def vocab(self, name):
+        return self.columns[name + '.vocab']
+
+    def counts(self, name):
+        """Returns the {value: number of entities} dict of a categorical feature."""
+        counts = np.bincount(self.columns[name + '.values'], minlength=len(self.vocab(name)))
+        return dict(zip(self.vocab(name).tolist(), counts.tolist()))
+
+    def feature(self, name, row):
+        offsets = self.columns[name + '.offsets']
+        values = self.columns[name + '.values'][offsets[row]:offsets[row+1]]
+        if name + '.vocab' in self.columns:
+            values = self.vocab(name)[values]
+        return values.tolist()
+
+    def __getitem__(self, id):
+        row = self.index[id]
+        return tuple(self.feature(name, row) for name in self.names)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Playlists(Mapping):
+    """
+    Read-only {user_id: [(song_id, behavior), ...]} mapping. The playlist of the i-th user is
+    stored as songs[offsets[i]:offsets[i+1]], codes into the song table rows, and
+    behaviors[offsets[i]:offsets[i+1]], codes into the behavior vocabulary.
+    """
+
+    def __init__(self, columns, song_ids):
+        self.columns = columns
+        self.song_ids = song_ids
+        self.users = columns['users']
+        self.offsets = columns['offsets']
+        self.songs = columns['songs']
+        self.behaviors = columns['behaviors']
+        self.behavior_vocab = columns['behaviors.vocab']
+        self.index = {id: i for i, id in enumerate(self.users.tolist())}
+
+    def behavior_counts(self):
+        """Returns the {behavior: number of records} dict."""
+        counts = np.bincount(self.behaviors, minlength=len(self.behavior_vocab))
+        return dict(zip(self.behavior_vocab.tolist(), counts.tolist()))
+
+    def rows(self, user_id):
+        """Returns the song rows and behavior codes of the user's playlist."""
+        i = self.index[user_id]
+        start, end = self.offsets[i], self.offsets[i+1]
+        return self.songs[start:end], self.behaviors[start:end]
+
+    def __getitem__(self, user_id):
+        songs, behaviors = self.rows(user_id)
+        return list(zip(self.song_ids[songs].tolist(), self.behavior_vocab[behaviors].tolist()))
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.users)
+
+
+class Points(Sequence):
+    """
+    Read-only list of (user_id, song_id) points, stored as user and song codes along with the
+    position of the song in the user's playlist.
+    """
+
+    def __init__(self, users, songs, positions, user_ids, song_ids):
+        self.users = users
+        self.songs = songs
+        self.positions = positions
+        self.user_ids = user_ids
+        self.song_ids = song_ids
+
+    def rows(self, i):
+        """Returns the i-th point as (playlist row, song row, position in the playlist)."""
+        return int(self.users[i]), int(self.songs[i]), int(self.positions[i])
+
+    def __getitem__(self, i):
+        return str(self.user_ids[self.users[i]]), str(self.song_ids[self.songs[i]])
+
+    def __len__(self):
+        return len(self.users)
+
+
+SONG_FEATURES = ('length', 'genre', 'artist', 'composer', 'language')
+USER_FEATURES = ('age', 'gender', 'city')
+
+def save_songs(fp, header, songs, popularity, length_set, *sets):
+    """popularity is the {id: number of plays} dict of processing.process_training."""
+    Table.save(fp, header, songs, SONG_FEATURES, dict(zip(SONG_FEATURES[1:], sets)),
+        popularity=np.fromiter((popularity.get(id, 0) for id in songs), np.int64, len(songs)),
+        **{'length.max': np.array(list(length_set), dtype=np.float64)})
+
+def load_songs(fp, header):
+    """Returns the song table followed by the feature sets expected by SongEncoder."""
+    songs = Table.load(fp, header, SONG_FEATURES)
+    return (songs, set(songs.columns['length.max'].tolist()),
+        *(encoded(songs.columns, name).tolist() for name in SONG_FEATURES[1:]))
+
+def save_users(fp, header, users, *sets):
+    Table.save(fp, header, users, USER_FEATURES, dict(zip(USER_FEATURES, sets)))
+
+def load_users(fp, header):
+    """Returns the user table followed by the feature sets expected by UserEncoder."""
+    users = Table.load(fp, header, USER_FEATURES)
+    return (users, *(encoded(users.columns, name).tolist() for name in USER_FEATURES))
+
+def first_positions(offsets, songs, point_users, point_songs):
+    """Position of the first occurrence of each point's song in its user's playlist."""
+    users = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+    keys, first = np.unique(users << 32 | songs, return_index=True)
+    index = np.searchsorted(keys, point_users.astype(np.int64) << 32 | point_songs)
+    return (first[index] - offsets[point_users]).astype(np.int32)
+
+def save_datapoints(fp, header, points, playlist, behaviors, song_index):
+    """Saves the output of processing.construct_datapoints, song_index maps ids to song rows."""
+    behavior_vocab = vocabulary(behaviors)
+    behavior_index = {b: i for i, b in enumerate(behavior_vocab.tolist())}
+    user_index = {u: i for i, u in enumerate(playlist)}
+    offsets, songs = ragged([[song_index[s] for s, _ in p] for p in playlist.values()], np.int32)
+    _, behaviors = ragged([[behavior_index[b] for _, b in p] for p in playlist.values()], np.int32)
+    point_users = np.fromiter((user_index[u] for u, _ in points), np.int32, len(points))
+    point_songs = np.fromiter((song_index[s] for _, s in points), np.int32, len(points))
+    save(fp, header,
+        users=np.array(list(playlist), dtype=str),
+        offsets=offsets,
+        songs=songs,
+        behaviors=behaviors,
+        **{'behaviors.vocab': behavior_vocab},
+        point_users=point_users,
+        point_songs=point_songs,
+        point_positions=first_positions(offsets, songs, point_users, point_songs))
+
+def derive_points(offsets, songs, min_len, max_len):
+    """
+    Points of the playlists, as in processing.construct_datapoints: each song following the
+    first min_len ones of a playlist of length in ]min_len, max_len[. Returns the point_users,
+    point_songs and point_positions columns.
+    """
+    lengths = np.diff(offsets)
+    users = np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+    positions = np.arange(offsets[-1]) - offsets[users]
+    kept = (positions >= min_len) & (min_len < lengths[users]) & (lengths[users] < max_len)
+    point_users, point_songs = users[kept], songs[kept]
+    return point_users, point_songs, first_positions(offsets, songs, point_users, point_songs)
+
+def append_datapoints(fp, header, records, song_index, user_ids, min_len, max_len):
+    """
+    Appends interaction records to the playlists saved in fp, as if they had been at the end
+    of the data given to processing.construct_datapoints: records of unknown users or songs are
+    left out, new users get a playlist after the existing ones and new behaviors are appended
+    to the vocabulary. Only the points of the modified playlists are derived again, the
+    rest of the columns are spliced rather than recomputed.
+
+    Parameters
+    ---
+    records: dict {'msno', 'song_id', 'source_system_tab'}
+        The user, song and behavior columns of the records, as returned by utils.misc.get.
+    song_index: dict {id: row}
+        The song table rows.
+    user_ids: container of string
+        The known users, i.e. with metadata.
+
+    Returns
+    ---
+        (number of appended records, number of new users)
+    """
+    columns = dict(load(fp, header))
+    user_codes, user_values = factorize(records['msno'])
+    song_codes, song_values = factorize(records['song_id'])
+    behavior_codes, behavior_values = factorize(records['source_system_tab'])
+
+    known = np.fromiter((u in user_ids for u in user_values.tolist()), bool, len(user_values))
+    song_rows = np.fromiter((song_index.get(s, -1) for s in song_values.tolist()), np.int32,
+        len(song_values))
+    kept = np.flatnonzero(known[user_codes] & (song_rows[song_codes] >= 0))
+
+    # New users are given the next rows, in order of appearance.
+    index = {u: i for i, u in enumerate(columns['users'].tolist())}
+    new_users = [u for u in dict.fromkeys(user_values[user_codes[kept]].tolist()) if u not in index]
+    index.update({u: len(index) + i for i, u in enumerate(new_users)})
+    columns['users'] = np.concatenate([columns['users'], np.array(new_users, dtype=str)])
+    user_rows = np.fromiter((index.get(u, -1) for u in user_values.tolist()), np.int32,
+        len(user_values))
+
+    columns.setdefault('behaviors.encoded', np.array(len(columns['behaviors.vocab'])))
+    columns['behaviors.vocab'], index = extend(columns['behaviors.vocab'],
+        behavior_values[np.unique(behavior_codes[kept])].tolist())
+    behavior_rows = np.fromiter((index.get(b, -1) for b in behavior_values.tolist()), np.int32,
+        len(behavior_values))
+
+    # The records of each user are placed after its current playlist: they are inserted at the
+    # end of it (in order, np.insert is stable), the playlists of new users being empty.
+    users = user_rows[user_codes[kept]]
+    order = np.argsort(users, kind='stable')
+    users = users[order]
+    offsets = columns['offsets']
+    offsets = np.concatenate([offsets, np.full(len(new_users), offsets[-1])])
+    at = offsets[users + 1]
+    columns['songs'] = np.insert(columns['songs'], at, song_rows[song_codes[kept]][order])
+    columns['behaviors'] = np.insert(columns['behaviors'], at,
+        behavior_rows[behavior_codes[kept]][order])
+    offsets[1:] += np.cumsum(np.bincount(users, minlength=len(offsets) - 1))
+    columns['offsets'] = offsets
+
+    # Only the points of the modified playlists are derived again, they replace the previous
+    # ones which, like the playlists, are grouped by user.
+    modified = np.unique(users)
+    lengths = offsets[modified + 1] - offsets[modified]
+    playlists = np.zeros(len(modified) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=playlists[1:])
+    rows = np.repeat(offsets[modified] - playlists[:-1], lengths) + np.arange(playlists[-1])
+    point_users, point_songs, point_positions = derive_points(playlists, columns['songs'][rows],
+        min_len, max_len)
+    point_users = modified[point_users].astype(np.int32)
+    starts = np.searchsorted(columns['point_users'], modified)
+    ends = np.searchsorted(columns['point_users'], modified, side='right')
+    bounds = np.searchsorted(point_users, modified)
+    bounds = np.append(bounds, len(point_users))
+    for name, derived in (('point_users', point_users), ('point_songs', point_songs),
+        ('point_positions', point_positions)):
+        column, parts, previous = columns[name], [], 0
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            parts += [column[previous:start], derived[bounds[i]:bounds[i + 1]]]
+            previous = end
+        columns[name] = np.concatenate(parts + [column[previous:]]).astype(column.dtype)
+    save(fp, header, **columns)
+    return len(kept), len(new_users)
+
+def load_datapoints(fp, header, song_ids):
+    """Returns (points, playlist, behaviors) as construct_datapoints does."""
+    columns = load(fp, header)
+    playlist = Playlists(columns, song_ids)
+    points = Points(columns['point_users'], columns['point_songs'], columns['point_positions'],
+        playlist.users, song_ids)
+    return points, playlist, set(encoded(columns, 'behaviors').tolist())
+
+
+def save_cache(fp, header, songs, users, training, testing, popularity):
+    """
+    Saves the processed songs, users, training and testing sets inside directory fp, along with
+    the number of plays of each song (see processing.process_training).
+    """
+    songs, *song_sets = songs
+    save_songs(os.path.join(fp, 'songs'), header, songs, popularity, *song_sets)
+    save_users(os.path.join(fp, 'users'), header, *users)
+    song_index = {id: i for i, id in enumerate(songs)}
+    save_datapoints(os.path.join(fp, 'training'), header, *training, song_index)
+    save_datapoints(os.path.join(fp, 'testing'), header, *testing, song_index)
+
+def load_cache(fp, header):
+    """
+    Loads the cache of directory fp, returns (songs, users, training, testing):
+        songs: (song table, *song feature sets), the table has a `popularity` column
+        users: (user table, *user feature sets)
+        training, testing: (points, playlist, behaviors)
+    Raises FileNotFoundError or utils.dumper.StaleCacheError if it needs to be (re)built.
+    """
+    songs = load_songs(os.path.join(fp, 'songs'), header)
+    users = load_users(os.path.join(fp, 'users'), header)
+    training = load_datapoints(os.path.join(fp, 'training'), header, songs[0].ids)
+    testing = load_datapoints(os.path.join(fp, 'testing'), header, songs[0].ids)
+    return songs, users, training, testing
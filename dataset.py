@@ -1,5 +1,10 @@
-import random
-from torch.utils.data import Dataset
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler, get_worker_info
+
+from encoding import PlaylistSignatures
+from utils.nn import Bags, Indexed
+from utils.sampling import NegativeSampler
 
 class MRSDataset(Dataset):
     """
@@ -9,18 +14,43 @@ class MRSDataset(Dataset):
     will the playlist known to the system when predicting s_i to be the highest scoring song.
     """
 
-    def __init__(self, user_song, playlist, users, songs, user_enc, song_enc, behavior_enc,
-        subset_size, Lt_playlist_len):
+    def __init__(self, user_song, playlist, users, song_table, user_enc, behavior_enc,
+        subset_size, Lt_playlist_len, sparse=False, sampler=None, dedup=False, signatures=None):
+        """
+        Parameters
+        ---
+            user_song: cache.Points, the data points
+            playlist: cache.Playlists, the complete playlists of the users
+            users: cache.Table, the user metadata
+            song_table: utils.table.EncodingTable, the precomputed song encodings
+            user_enc, behavior_enc: the user (encoding.UserEncoder) and behavior encoders
+            subset_size: number of songs to rate, including the label
+            Lt_playlist_len: length of the long-term playlist window
+            sparse: whether to return sparse (indices, weights) pairs instead of dense vectors
+            sampler: utils.sampling.NegativeSampler, draws the negatives, uniform by default
+            dedup: whether items hold the song table rows of the playlist and subset instead of
+                their encodings, batches are then assembled with `DedupCollate`
+            signatures: encoding.PlaylistSignatures of the playlists, when already computed
+                for another dataset of the same playlists
+        """
         self.user_song = user_song
         self.playlist = playlist
         self.users = users
-        self.songs = songs
+        self.song_table = song_table
 
         self.user_enc = user_enc
-        self.song_enc = song_enc
         self.behavior_enc = behavior_enc
         self.subset_size = subset_size
         self.Lt_playlist_len = Lt_playlist_len
+        self.sparse = sparse
+        self.dedup = dedup
+        self.sampler = sampler or NegativeSampler(len(song_table))
+
+        # Playlist signatures of every prefix, and the encoding of each behavior value.
+        self.signatures = signatures or PlaylistSignatures(playlist.offsets, playlist.songs,
+            song_table)
+        self.behaviors = np.stack([behavior_enc([b]) for b in playlist.behavior_vocab.tolist()]
+            + [np.zeros(len(behavior_enc))]) # keeps the array 2D with an empty vocabulary
 
     def __getitem__(self, index):
         """
@@ -29,54 +59,238 @@ class MRSDataset(Dataset):
             [0: (user, song), ..., index: (user_id, label_id), ..., n: (user, song)]
                                                     |
                                                    u, s
-        From there, we locate the song's position in the user's complete playlist:
+        The song's position in the user's complete playlist is precomputed (see cache.Points):
             [s_1, ...,  s_k  ...,  s_i-1,  s_i,  ...,  s_n]
                          \___________/      |
                        partial playlist  label=label_id
 
         This partial playlist will be used in two different ways: merged in the encoding of the
-        user and encoded as a sequences of varying length which will be fed to a RNN.
+        user and encoded as a sequences of varying length which will be fed to a RNN. Only the
+        last Lt_playlist_len songs are read: the signature of the whole partial playlist is
+        looked up in PlaylistSignatures, so the cost doesn't depend on the position.
 
         Returns
         ---
         Returned vectors are: (user, playlist, behaviors, subset)
             user: the user static encoding
             playlist: sequence of song encodings
-            behaviors: sequence of behavior encodings
-            subset: a sample list of song encodings including the label in 1st position
+            behaviors: (sequence, behavior_mhe) array of behavior encodings
+            subset: song encodings of the label, in 1st position, followed by the negatives
+                drawn by the sampler
+        In sparse mode, user and song encodings are (indices, weights) pairs instead, these
+        batches should be assembled with `collate`. With dedup, playlist and subset are arrays
+        of song table rows.
         """
-        user_id, label_id = self.user_song[index]
-        playlist = []
-        behaviors = []
-        for song_id, behavior in self.playlist[user_id]:
-            if song_id == label_id:
-                break
-            playlist.append(song_id)
-            behaviors.append(behavior)
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        """
+        Returns the items of a whole batch, see __getitem__. The DataLoader calls it with the
+        indices of each batch so that the negatives of the batch are drawn at once.
+        """
+        points = [self.user_song.rows(i) for i in indices]
+        labels = np.array([label for _, label, _ in points], dtype=np.int64)
+        histories = None
+        if self.sampler.exclude_history:
+            offsets = self.playlist.offsets
+            histories = [self.playlist.songs[offsets[user]:offsets[user] + position]
+                for user, _, position in points]
+        negatives = self.sampler(labels, self.subset_size - 1, histories)
+
+        items = []
+        for (user, _, position), label, rows in zip(points, labels, negatives):
+            if self.dedup:
+                subset = np.concatenate([[label], rows]).astype(np.int64)
+                items.append((*self.encode(user, position, gather=False), subset))
+            else:
+                subset = [self.gather_song(row) for row in [label, *rows]]
+                items.append((*self.encode(user, position), subset))
+        return items
+
+    def encode(self, user, position, gather=True):
+        """
+        Returns the (user, playlist, behaviors) encodings of the user at playlist row `user`
+        knowing the first `position` songs of its playlist. Without gather, the playlist is
+        the array of its song table rows.
+        """
+        start = self.playlist.offsets[user]
+        window = slice(start + max(0, position - self.Lt_playlist_len), start + position)
 
         # Encode both the song's metadata and the user's behavior when listening to that song.
-        for i, (song, behavior) in enumerate(zip(playlist, behaviors)):
-            playlist[i] = self.encode_song(song)
-            behaviors[i] = self.behavior_enc([behavior])
+        playlist_Lt = [self.gather_song(row) for row in self.playlist.songs[window]] if gather \
+            else np.asarray(self.playlist.songs[window], dtype=np.int64)
+        behaviors_Lt = self.behaviors[self.playlist.behaviors[window]]
+
+        user_id = self.playlist.users[user]
+        signature = self.signatures(user, position)
+        user = self.user_enc.with_signature(*self.users[user_id], signature, sparse=self.sparse)
+        return user, playlist_Lt, behaviors_Lt
+
+    def gather_song(self, row):
+        """Reads the precomputed encoding of the song at index row of the song table."""
+        if self.sparse:
+            return self.song_table.sparse(row)
+        return self.song_table.dense(row)
+
+    def lengths(self):
+        """Returns the size of the long-term playlist of every point."""
+        return np.minimum(np.asarray(self.user_song.positions), self.Lt_playlist_len)
+
+    def __len__(self):
+        return len(self.user_song)
+
+
+def pad(sequences, width):
+    """Stacks sequences of vectors into a right-padded (seq, batch, width) float32 array."""
+    padded = np.zeros((max(map(len, sequences)), len(sequences), width), dtype=np.float32)
+    for i, sequence in enumerate(sequences):
+        if len(sequence):
+            padded[:len(sequence), i] = sequence
+    return padded
+
+def collate_songs(song_table, rows, sparse=False, dtype=torch.float32):
+    """
+    Gathers the song table rows into a (len(rows), song_mhe) tensor of the given dtype, or a
+    Bags if sparse.
+    """
+    if sparse:
+        indices, offsets, weights = song_table.gather(rows)
+        return Bags(torch.from_numpy(indices), torch.from_numpy(offsets[:-1]),
+            torch.from_numpy(weights), (len(rows),))
+    return torch.from_numpy(song_table.dense_rows(rows)).to(dtype)
 
-        user = self.encode_user(user_id, playlist)
+def collate_users(items, dtype=torch.float32):
+    """
+    Collates (user, playlist, behaviors) encodings, see MRSDataset.encode, into (user,
+    playlist, behaviors, lengths) tensors of shapes (batch, user_mhe), (seq, batch, song_mhe),
+    (seq, batch, behavior_mhe) and (batch,). Playlists are right-padded to the longest one
+    and lengths holds their actual size. In sparse mode, user and playlist are
+    utils.nn.Bags of the same shapes minus the encoding dimension, padding songs being empty.
+    Dense encodings are returned in dtype, e.g. torch.bfloat16 for utils.fastmath.autocast.
+    """
+    users, playlists, behaviors = zip(*items)
+    lengths = torch.tensor([len(p) for p in playlists], dtype=torch.long)
+    behaviors = torch.from_numpy(pad(behaviors, behaviors[0].shape[1])).to(dtype)
+    if isinstance(users[0], tuple):
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        user = Bags.from_sparse(users, (len(items),))
+        playlist = Bags.from_sparse([p[t] if t < len(p) else empty
+            for t in range(int(lengths.max())) for p in playlists],
+            (int(lengths.max()), len(items)))
+    else:
+        user = torch.from_numpy(np.stack(users)).to(dtype)
+        playlist = torch.from_numpy(pad(playlists, playlists[0][0].shape[0])).to(dtype)
+    return user, playlist, behaviors, lengths
 
-        playlist_Lt = playlist[-self.Lt_playlist_len:]
-        behaviors_Lt = behaviors[-self.Lt_playlist_len:]
+def collate(batch, dtype=torch.float32):
+    """
+    Collates MRSDataset items into batched (user, playlist, behaviors, subset, lengths), see
+    collate_users, subset being of shape (batch, subset, song_mhe) or a Bags in sparse mode.
+    """
+    user, playlist, behaviors, lengths = collate_users([item[:3] for item in batch], dtype)
+    subsets = [item[3] for item in batch]
+    if isinstance(subsets[0][0], tuple):
+        subset = Bags.from_sparse([song for s in subsets for song in s],
+            (len(batch), len(subsets[0])))
+    else:
+        subset = torch.from_numpy(np.stack([np.stack(s) for s in subsets])).to(dtype)
+    return user, playlist, behaviors, subset, lengths
 
-        # Randomly sample a subset from the complete list of songs.
-        subset_ids = random.sample(self.songs.keys(), self.subset_size - 1)
-        subset = [self.encode_song(song_id) for song_id in subset_ids]
 
-        label = self.encode_song(label_id)
+class DedupCollate:
+    """
+    Collates the items of a MRSDataset with dedup into (user, playlist, behaviors, subset,
+    lengths), see collate, playlist and subset being utils.nn.Indexed: the encodings of the
+    unique songs of the batch are gathered once from the song table, along with the
+    (seq, batch) and (batch, subset) indices of the playlist and subset songs among them.
+    Padding steps of the playlists point to the first unique song.
+    """
+
+    def __init__(self, song_table, sparse=False, dtype=torch.float32):
+        self.song_table = song_table
+        self.sparse = sparse
+        self.dtype = dtype
 
-        return user, playlist_Lt, behaviors_Lt, [label] + subset
+    def __call__(self, batch):
+        users, playlists, behaviors, subsets = zip(*batch)
+        lengths = torch.tensor([len(p) for p in playlists], dtype=torch.long)
+        behaviors = torch.from_numpy(pad(behaviors, behaviors[0].shape[1])).to(self.dtype)
+        if self.sparse:
+            user = Bags.from_sparse(users, (len(batch),))
+        else:
+            user = torch.from_numpy(np.stack(users)).to(self.dtype)
 
-    def encode_user(self, user_id, playlist):
-        return self.user_enc(*self.users[user_id], playlist)
+        # Unique songs, playlists and subsets are then rewritten as indices into them.
+        unique, inverse = np.unique(np.concatenate([*playlists, *subsets]), return_inverse=True)
+        songs = collate_songs(self.song_table, unique, self.sparse, self.dtype)
+        n_played = int(lengths.sum())
+        playlist = np.zeros((int(lengths.max()), len(batch)), dtype=np.int64)
+        mask = np.arange(len(playlist))[:, None] < lengths.numpy()
+        playlist.T[mask.T] = inverse[:n_played] # playlists are concatenated in batch order
+        subset = inverse[n_played:].reshape(len(batch), -1)
+        return (user, Indexed(songs, torch.from_numpy(playlist)), behaviors,
+            Indexed(songs, torch.from_numpy(subset)), lengths)
 
-    def encode_song(self, song_id):
-        return self.song_enc(*self.songs[song_id])
+
+def seed_worker(worker_id):
+    """
+    DataLoader worker_init_fn: reseeds the negative sampler of the worker's dataset copy with the
+    worker's seed, derived by torch from the base seed of the DataLoader and the worker id.
+    """
+    info = get_worker_info()
+    info.dataset.sampler.seed(info.seed)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping points of similar playlist lengths together, so that little padding
+    is needed. Points are shuffled, stably sorted by length and cut into batches, the order of
+    the batches is shuffled in turn.
+
+    In distributed training, each rank iterates over its own share of the batches: the ranks
+    must build the same batches, so they share the seed and call set_epoch before each epoch.
+    With even, every rank runs the same number of steps, as DistributedDataParallel requires,
+    and the last few batches may be left out. Given a seed, an epoch can be resumed from any step.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, rank=0, world_size=1,
+        seed=None, even=True):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.even = even
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """Sets the epoch of the next iteration, which skips the first `start` batches."""
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        rng = np.random if self.seed is None else np.random.default_rng((self.seed, self.epoch))
+        indices = rng.permutation(len(self.lengths)) if self.shuffle \
+            else np.arange(len(self.lengths))
+        indices = indices[np.argsort(self.lengths[indices], kind='stable')]
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        order = rng.permutation(len(batches)) if self.shuffle else np.arange(len(batches))
+        if self.even:
+            order = order[:len(order) - len(order) % self.world_size]
+        order = order[self.rank::self.world_size]
+        for i in order[self.start:]:
+            yield batches[i].tolist()
 
     def __len__(self):
-        return len(self.user_song)
+        if self.drop_last:
+            n_batches = len(self.lengths) // self.batch_size
+        else:
+            n_batches = -(-len(self.lengths) // self.batch_size)
+        if self.even:
+            return max(0, n_batches // self.world_size - self.start)
+        return max(0, len(range(self.rank, n_batches, self.world_size)) - self.start)
@@ -1,46 +1,137 @@
 import numpy as np
-from utils.encoders import Encoder, LinearEncoder, MHEncoder
+from utils.encoders import Encoder, LinearEncoder, MHEncoder, HashedMHEncoder
+
+def categorical(values, hashing=None):
+    """
+    MHEncoder of the values, or HashedMHEncoder(**hashing) given the hashing parameters
+    (buckets, signed, counts, min_count) of the feature.
+    """
+    return HashedMHEncoder(**hashing) if hashing else MHEncoder(values)
+
 
 class UserEncoder(Encoder):
-    """User encoder: encodes the user's age, gender, city and complete playlist."""
+    """
+    User encoder: encodes the user's age, gender, city and complete playlist. hashing maps the
+    feature names ('age', 'gender', 'city') to hash, see `categorical`.
+    """
 
-    def __init__(self, ages, genders, cities, song_encoder):
+    def __init__(self, ages, genders, cities, song_encoder, hashing=None):
         assert(isinstance(song_encoder, SongEncoder))
-        super().__init__(MHEncoder(ages), MHEncoder(genders), MHEncoder(cities))
+        hashing = hashing or {}
+        super().__init__(categorical(ages, hashing.get('age')),
+            categorical(genders, hashing.get('gender')), categorical(cities, hashing.get('city')))
         self.song_encoder = song_encoder
 
     def playlist_signature(self, playlist_encoded):
-        return np.clip(sum(playlist_encoded), 0, 1)[1:] # remove linear component i.e. here the 1st
+        signature = np.clip(sum(np.abs(playlist_encoded)), 0, 1) # hashed bits can be negative
+        return signature[1:] # remove linear component i.e. here the 1st
+
+    def sparse_signature(self, playlist_sparse):
+        """Sparse counterpart of `playlist_signature` on a list of (indices, weights) pairs."""
+        indices = np.unique(np.concatenate([i for i, _ in playlist_sparse] + [[]])).astype(np.int64)
+        return indices[indices > 0] - 1 # same here, the linear component has index 0
 
     def __call__(self, age, gender, city, playlist_encoded):
         user_encoded = super().__call__(age, gender, city)
         playlist_signature = self.playlist_signature(playlist_encoded)
         return np.concatenate([user_encoded, playlist_signature])
 
+    def sparse(self, age, gender, city, playlist_sparse):
+        return self.with_signature(age, gender, city, self.sparse_signature(playlist_sparse),
+            sparse=True)
+
+    def with_signature(self, age, gender, city, signature, sparse=False):
+        """Encodes the user given the bit positions of its playlist signature."""
+        if sparse:
+            indices, weights = super().sparse(age, gender, city)
+            return (np.concatenate([indices, signature + super().__len__()]),
+                np.concatenate([weights, np.ones(len(signature), dtype=np.float32)]))
+        playlist_signature = np.zeros(len(self.song_encoder) - 1, dtype=np.float32)
+        playlist_signature[signature] = 1
+        return np.concatenate([super().__call__(age, gender, city), playlist_signature],
+            dtype=np.float32) # as the song table, no conversion when batched
+
     def __len__(self):
         return super().__len__() + len(self.song_encoder) - 1
 
 
 class SongEncoder(Encoder):
-    """Song encoder: encodes the song's length, genres, artists, composers and languages."""
+    """
+    Song encoder: encodes the song's length, genres, artists, composers and languages. hashing
+    maps the feature names ('genre', 'artist', 'composer', 'language') to hash, see `categorical`.
+    """
 
-    def __init__(self, lengths, genres, artists, composers, languages):
-        super().__init__(LinearEncoder(lengths), MHEncoder(genres), MHEncoder(artists),
-            MHEncoder(composers), MHEncoder(languages))
+    def __init__(self, lengths, genres, artists, composers, languages, hashing=None):
+        hashing = hashing or {}
+        super().__init__(LinearEncoder(lengths), categorical(genres, hashing.get('genre')),
+            categorical(artists, hashing.get('artist')),
+            categorical(composers, hashing.get('composer')),
+            categorical(languages, hashing.get('language')))
 
 
 class BehaviorEncoder(Encoder):
     """
-    Song listening behavior encoding: a wrapper for a single MHEncoder. It's needed to
-    manually merge some feature values together e.g. 'null' and 'settings'.
+    Song listening behavior encoding: a wrapper for a single MHEncoder, or HashedMHEncoder given
+    hashing parameters. It's needed to manually merge some feature values together e.g. 'null'
+    and 'settings', which are encoded as no behavior at all.
     """
 
-    def __init__(self, behaviors):
-        behaviors.discard('null')
-        behaviors.discard('settings')
-        super().__init__(MHEncoder(behaviors))
+    MERGED = {'null', 'settings'}
+
+    def __init__(self, behaviors, hashing=None):
+        behaviors -= self.MERGED
+        super().__init__(categorical(behaviors, hashing))
+        if hashing: # no vocabulary to leave them out of, hashed values are excluded instead
+            self.encoders[0].excluded |= self.MERGED
 
     def __call__(self, behavior):
-        if (behavior == 'null' or behavior == 'settings'):
-            behavior = ''
-        return super().__call__(behavior)
+        return super().__call__([b for b in behavior if b not in self.MERGED])
+
+    def sparse(self, behavior):
+        return super().sparse([b for b in behavior if b not in self.MERGED])
+
+
+class PlaylistSignatures:
+    """
+    Index of the playlist signatures (see UserEncoder.playlist_signature) of every playlist
+    prefix. For each user, the signature bits are sorted by the position of the first song of
+    the playlist having them. The signature of p[:position] is then a contiguous slice of
+    these, its end is found by binary search.
+    """
+
+    def __init__(self, offsets, songs, song_table):
+        """
+        Parameters
+        ---
+        offsets, songs: np.ndarray
+            The playlists as a ragged array of song table rows (see cache.Playlists).
+        song_table: utils.table.EncodingTable
+            The song encodings.
+        """
+        n_users = len(offsets) - 1
+        users = np.repeat(np.arange(n_users), np.diff(offsets))
+        positions = np.arange(len(songs)) - offsets[users]
+
+        # Bits of every song of every playlist, along with their user and position.
+        indptr = np.asarray(song_table.indptr)
+        counts = indptr[songs + 1] - indptr[songs]
+        starts = np.repeat(indptr[songs] - np.cumsum(counts) + counts, counts)
+        bits = np.asarray(song_table.indices)[starts + np.arange(counts.sum())].astype(np.int64)
+        users, positions = np.repeat(users, counts), np.repeat(positions, counts)
+
+        # Remove the linear component and keep the first occurrence of each (user, bit).
+        valid = bits > 0
+        bits, users, positions = bits[valid] - 1, users[valid], positions[valid]
+        order = np.lexsort((positions, bits, users))
+        keys = users[order] * song_table.width + bits[order]
+        first = order[np.unique(keys, return_index=True)[1]]
+
+        order = first[np.lexsort((positions[first], users[first]))]
+        self.bits = bits[order]
+        self.positions = positions[order]
+        self.offsets = np.searchsorted(users[order], np.arange(n_users + 1))
+
+    def __call__(self, user, position):
+        """Returns the signature bits of the playlist of user (row) truncated to position."""
+        start, end = self.offsets[user], self.offsets[user+1]
+        return self.bits[start:start + np.searchsorted(self.positions[start:end], position)]
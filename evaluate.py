@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from pipeline import add_arguments, load_data
+from dataset import MRSDataset, collate
+from recommend import Recommender
+from model import DTNMR
+from utils.fastmath import PRECISIONS, autocast
+from utils.sampling import NegativeSampler
+
+def ranking_metrics(ranks, k):
+    """HR@K, NDCG@K and MRR given the 0-based rank of the label of each point."""
+    ranks = np.asarray(ranks, dtype=np.float64)
+    hit = ranks < k
+    return {'HR@%i' % k: hit.mean(),
+        'NDCG@%i' % k: np.where(hit, 1 / np.log2(ranks + 2), 0).mean(),
+        'MRR': (1 / (ranks + 1)).mean()}
+
+
+def subset_metrics(model, dataset, batch_size=512, dtype=torch.float32):
+    """
+    Loss and accuracy of the model on the sampled subsets of every point of the dataset, run
+    in dtype (see utils.fastmath). Also returns the (n_points, subset) scores.
+    """
+    criterion = nn.CrossEntropyLoss(reduction='sum')
+    loss, correct, scores = 0., 0, []
+    with torch.inference_mode(), autocast(dtype):
+        for start in range(0, len(dataset), batch_size):
+            indices = list(range(start, min(start + batch_size, len(dataset))))
+            y_hat = model(*collate(dataset.__getitems__(indices), dtype)).float()
+            loss += criterion(y_hat, torch.zeros(len(y_hat), dtype=torch.long)).item()
+            correct += (y_hat.argmax(dim=1) == 0).sum().item() # the label is always 1st
+            scores.append(y_hat)
+    n = max(len(dataset), 1)
+    return {'loss': loss / n, 'accuracy': correct / n}, torch.cat(scores).numpy()
+
+
+class Evaluator:
+    """
+    Ranking evaluation of a model on the points of a dataset. The label of each point is ranked
+    either against the whole catalogue, or against a fixed set of sampled negatives: these are
+    drawn once with the given seed so that successive evaluations are comparable. Song
+    embeddings are computed once per evaluation (see recommend.Recommender), and the catalogue
+    sorted once by score so that full-catalogue ranks are found by binary search.
+    """
+
+    def __init__(self, dataset, k=10, negatives=None, seed=0, batch_size=512):
+        """
+        Parameters
+        ---
+            dataset: MRSDataset, the points to evaluate on
+            k: cutoff of HR@K and NDCG@K
+            negatives: number of negatives per point, None to rank against the whole catalogue
+            seed: seed of the negative sampling
+            batch_size: number of points scored at once
+        """
+        self.dataset = dataset
+        self.k = k
+        self.batch_size = batch_size
+        self.negatives = None
+        if negatives is not None:
+            # Negatives are drawn among all songs but the label.
+            n_songs = len(dataset.song_table)
+            labels = np.asarray(dataset.user_song.songs)[:, None]
+            rng = np.random.default_rng(seed)
+            self.negatives = rng.integers(0, n_songs - 1, (len(dataset), negatives))
+            self.negatives += self.negatives >= labels
+
+    def __call__(self, model):
+        """Returns the dict of ranking metrics of the model."""
+        training = model.training
+        with torch.inference_mode():
+            ranks = self.ranks(Recommender(model, self.dataset.song_table))
+        model.train(training)
+        return ranking_metrics(ranks, self.k)
+
+    def ranks(self, recommender):
+        """
+        Computes the rank of the label of every point. The score of the user's features is
+        the same for the label and every candidate so it can't change the ranks: they only
+        depend on the song scores, and these metrics don't measure the user tower.
+        """
+        song_scores = recommender.embeddings @ recommender.w_song
+        label_scores = song_scores[np.asarray(self.dataset.user_song.songs)]
+        if self.negatives is None: # number of songs of the catalogue scored above the label
+            ordered = np.sort(song_scores)
+            return len(ordered) - np.searchsorted(ordered, label_scores, side='right')
+
+        ranks = []
+        for start in range(0, len(self.dataset), self.batch_size):
+            indices = slice(start, start + self.batch_size)
+            candidates = song_scores[self.negatives[indices]]
+            ranks.append((candidates > label_scores[indices, None]).sum(axis=1))
+        return np.concatenate(ranks)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Evaluates the ranking quality of a saved model.')
+
+    # ~ data processing
+    add_arguments(parser)
+
+    # ~ evaluation params
+    parser.add_argument('--model', metavar='PATH', type=str, required=True,
+        help='Model file, as saved by run.py --save.')
+    parser.add_argument('--split', choices=('train', 'test'), default='test',
+        help='Set on which the model is evaluated.')
+    parser.add_argument('--k', metavar='NB', type=int, default=10,
+        help='Cutoff of the HR@K and NDCG@K metrics.')
+    parser.add_argument('--negatives', metavar='NB', type=int, default=None,
+        help='Number of sampled negatives per point, ranks against the whole catalogue if unset.')
+    parser.add_argument('--seed', metavar='NB', type=int, default=0,
+        help='Seed of the negative sampling.')
+    parser.add_argument('--long-term-len', metavar='NB', type=int, default=20,
+        help='Length of a long-term user playlist.')
+    parser.add_argument('--batch-size', metavar='NB', type=int, default=512,
+        help='Number of points scored at once.')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+        help='Compares the metrics in this dtype to the float32 ones, see run.py --precision.')
+    parser.add_argument('--subset-size', metavar='NB', type=int, default=5,
+        help='Number of songs per point, including the label, of the loss in the comparison.')
+
+    args = parser.parse_args()
+
+    data = load_data(args)
+    model = DTNMR.load(args.model, **data.sizes())
+    points, playlist = (data.train_points, data.train_playlist) if args.split == 'train' \
+        else (data.test_points, data.test_playlist)
+    dataset = MRSDataset(points, playlist, data.users, data.song_table, data.encode_user,
+        data.encode_behavior, subset_size=1, Lt_playlist_len=args.long_term_len,
+        sparse=model.sparse)
+
+    evaluator = Evaluator(dataset, k=args.k, negatives=args.negatives, seed=args.seed,
+        batch_size=args.batch_size)
+    if args.precision == 'fp32':
+        print(' - '.join('{}={:.4f}'.format(name, value)
+            for name, value in evaluator(model).items()))
+        exit()
+
+    # Parity report: loss and accuracy on the same sampled subsets, and ranking metrics.
+    results, scores = {}, {}
+    for precision in ('fp32', args.precision):
+        subsets = MRSDataset(points, playlist, data.users, data.song_table, data.encode_user,
+            data.encode_behavior, subset_size=args.subset_size,
+            Lt_playlist_len=args.long_term_len, sparse=model.sparse,
+            sampler=NegativeSampler(len(data.song_table), seed=args.seed))
+        results[precision], scores[precision] = subset_metrics(model, subsets, args.batch_size,
+            PRECISIONS[precision])
+        with autocast(PRECISIONS[precision]):
+            results[precision].update(evaluator(model))
+    results['difference'] = {name: results[args.precision][name] - value
+        for name, value in results['fp32'].items()}
+    for precision, metrics in results.items():
+        print('{:<10} '.format(precision) + ' - '.join('{}={:.4f}'.format(name, value)
+            for name, value in metrics.items()))
+    print('maximum score difference: {:.4g}, top-1 agreement: {:.4f}'.format(
+        np.abs(scores[args.precision] - scores['fp32']).max(),
+        (scores[args.precision].argmax(axis=1) == scores['fp32'].argmax(axis=1)).mean()))
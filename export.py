@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import copy, io, json, os, time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from pipeline import add_arguments, load_data
+from dataset import MRSDataset, collate
+from model import DTNMR
+from utils.nn import SparseLinear
+from utils.sampling import NegativeSampler
+
+"""
+Export of a trained model for CPU inference. DTNMR.forward is traced into TorchScript: a
+static graph, without Python overhead, which torch.jit.load runs without this code base. A
+second artifact quantizes the weights of the Linear and LSTM layers to int8 (dynamic
+quantization: activations are quantized on the fly), 4 times smaller. Both are checked
+against the float model on a held-out slice of the data, and timed.
+
+The exported models take dense inputs, as returned by dataset.collate with sparse=False:
+    scores = torch.jit.load('export/int8.pt')(user, playlist, behaviors, subset, lengths)
+"""
+
+def densify(model):
+    """Returns a copy of the model taking dense encodings, its SparseLinear layers replaced."""
+    model = copy.deepcopy(model)
+    for mlp in (model.USFC, model.MFC):
+        if isinstance(mlp.input, SparseLinear):
+            mlp.input = mlp.input.to_dense()
+    model.sparse = model.config['sparse'] = False
+    return model
+
+def quantize(model):
+    """Dynamic int8 quantization of the Linear and LSTM layers."""
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+
+def trace(model, example):
+    """Traces the forward pass on an example batch, the graph accepts any batch shape."""
+    with torch.no_grad():
+        return torch.jit.trace(model.eval(), example, check_trace=False)
+
+def held_out(data, split='test', n_points=2048, batch_size=256, subset_size=5,
+    Lt_playlist_len=20, seed=0):
+    """Returns dense batches of n_points random points of the split, with fixed negatives."""
+    points, playlist = (data.train_points, data.train_playlist) if split == 'train' \
+        else (data.test_points, data.test_playlist)
+    dataset = MRSDataset(points, playlist, data.users, data.song_table, data.encode_user,
+        data.encode_behavior, subset_size, Lt_playlist_len,
+        sampler=NegativeSampler(len(data.song_table), seed=seed))
+    indices = np.flatnonzero(np.asarray(points.positions) > 0) # points with a known playlist
+    rng = np.random.default_rng(seed)
+    indices = np.sort(rng.choice(indices, min(n_points, len(indices)), replace=False))
+    return [collate(dataset.__getitems__(indices[i:i + batch_size].tolist()))
+        for i in range(0, len(indices), batch_size)]
+
+def size(model):
+    """Size in bytes of the serialized model, a TorchScript module or a DTNMR state."""
+    buffer = io.BytesIO()
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, buffer)
+    else:
+        torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def run(model, batches, repeats=3):
+    """Returns the scores of every batch and the latencies (ms) of the forward passes."""
+    latencies = []
+    with torch.inference_mode():
+        for _ in range(repeats):
+            scores = []
+            for batch in batches:
+                start = time.perf_counter()
+                scores.append(model(*batch))
+                latencies.append((time.perf_counter() - start) * 1000)
+    return torch.cat(scores).numpy(), np.array(latencies)
+
+def report(models, batches, repeats=3):
+    """
+    Compares the models {name: model} to the first one, the float reference: maximum score
+    difference, accuracy (label ranked first among the subset), agreement of the top-1 song
+    with the reference, size and latency per batch.
+    """
+    results, reference = {}, None
+    for name, model in models.items():
+        run(model, batches[:1], repeats=1) # warm-up, e.g. the first calls of a traced graph
+        scores, latencies = run(model, batches, repeats)
+        if reference is None:
+            reference = scores
+        results[name] = {
+            'max_abs_diff': float(np.abs(scores - reference).max()),
+            'accuracy': float((scores.argmax(axis=1) == 0).mean()),
+            'agreement': float((scores.argmax(axis=1) == reference.argmax(axis=1)).mean()),
+            'size_bytes': size(model),
+            'latency_ms_mean': float(latencies.mean()),
+            'latency_ms_p50': float(np.percentile(latencies, 50)),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Exports a model to TorchScript, float and int8.')
+
+    # ~ data processing
+    add_arguments(parser)
+
+    # ~ export params
+    parser.add_argument('--model', metavar='PATH', type=str, required=True,
+        help='Model file, as saved by run.py --save, or a checkpoint.')
+    parser.add_argument('--output', metavar='PATH', type=str, default='export',
+        help='Directory where float.pt, int8.pt and report.json are written.')
+    parser.add_argument('--split', choices=('train', 'test'), default='test',
+        help='Set from which the held-out points are taken.')
+    parser.add_argument('--points', metavar='NB', type=int, default=2048,
+        help='Number of held-out points of the parity check and timings.')
+    parser.add_argument('--batch-size', metavar='NB', type=int, default=256,
+        help='Number of points per batch.')
+    parser.add_argument('--subset-size', metavar='NB', type=int, default=5,
+        help='Number of songs rated per point, including the label.')
+    parser.add_argument('--long-term-len', metavar='NB', type=int, default=20,
+        help='Length of a long-term user playlist.')
+    parser.add_argument('--repeats', metavar='NB', type=int, default=3,
+        help='Number of timed passes over the held-out points.')
+    parser.add_argument('--max-accuracy-drop', metavar='RATIO', type=float, default=0.01,
+        help='Accuracy loss of the int8 model over which the export is reported as failed.')
+    parser.add_argument('--seed', metavar='NB', type=int, default=0,
+        help='Seed of the held-out points and their negatives.')
+
+    args = parser.parse_args()
+
+    data = load_data(args)
+    model = densify(DTNMR.load(args.model, **data.sizes())).eval()
+    batches = held_out(data, args.split, args.points, args.batch_size, args.subset_size,
+        args.long_term_len, args.seed)
+    if not batches:
+        parser.error('no held-out point in the {} split'.format(args.split))
+
+    os.makedirs(args.output, exist_ok=True)
+    exported = {'float': trace(model, batches[0]), 'int8': trace(quantize(model), batches[0])}
+    for name, module in exported.items():
+        torch.jit.save(module, os.path.join(args.output, name + '.pt'))
+
+    results = report({'eager': model, **exported}, batches, args.repeats)
+    drop = results['eager']['accuracy'] - results['int8']['accuracy']
+    results['passed'] = bool(drop <= args.max_accuracy_drop)
+    with open(os.path.join(args.output, 'report.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for name, result in results.items():
+        if isinstance(result, dict):
+            print('{}: '.format(name) + ' - '.join('{}={:.4g}'.format(key, value)
+                for key, value in result.items()))
+    print('parity check {}: int8 accuracy drop {:.4f}'.format(
+        'passed' if results['passed'] else 'FAILED', drop))
+    if not results['passed']:
+        exit(1)
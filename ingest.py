@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+
+from pipeline import add_arguments, cache_header, load_data, INTERACTION_COLUMNS, SONG_COLUMNS, \
+    USER_COLUMNS
+from processing import process_songs, process_users
+from cache import Table, USER_FEATURES, append_datapoints
+from utils.misc import get
+from utils.process import factorize
+from utils.table import EncodingTable
+
+"""
+Incremental update of the cache with new interaction records, e.g. a daily log, instead of
+rebuilding it from all the csv files with --reload. Everything is appended: the users, songs
+and behaviors already in the cache keep their rows and vocabulary codes, and the encoders are
+still built from the vocabularies of the initial build, so trained models remain valid (feature
+values seen for the first time are encoded as unknown).
+"""
+
+def ingest(args):
+    header = cache_header(args)
+    data = load_data(args)
+    songs_fp, users_fp = os.path.join(args.cache, 'songs'), os.path.join(args.cache, 'users')
+
+    # Users with metadata, new ones are appended to the user table.
+    users = data.users
+    if args.members:
+        _, members = get(args.members, columns=USER_COLUMNS, categorical=USER_COLUMNS)
+        new_users, *_ = process_users(members)
+        print('{} new users with metadata'.format(len(users.append(users_fp, header, new_users))))
+        users = Table.load(users_fp, header, USER_FEATURES)
+
+    _, records = get(args.interactions, columns=INTERACTION_COLUMNS,
+        categorical=INTERACTION_COLUMNS)
+
+    # Songs: new songs are appended to the catalogue, they are only filtered on their metadata
+    # (there is no play count to compare to the most popular songs yet).
+    songs, new_songs = data.songs, {}
+    if args.songs:
+        _, songs_csv = get(args.songs, columns=SONG_COLUMNS, categorical=SONG_COLUMNS)
+        new_songs, *_ = process_songs(songs_csv, dict.fromkeys(songs_csv['song_id'], 1), 1, top=0)
+        new_songs = {id: row for id, row in new_songs.items() if id not in songs}
+    ids = songs.ids.tolist() + list(new_songs)
+    song_index = {id: i for i, id in enumerate(ids)}
+
+    # Play counts of the catalogue songs.
+    popularity = np.concatenate([songs.columns['popularity'], np.zeros(len(new_songs), np.int64)])
+    if args.split == 'train':
+        codes, values = factorize(records['song_id'])
+        rows = np.fromiter((song_index.get(s, -1) for s in values.tolist()), np.int64,
+            len(values))[codes]
+        popularity += np.bincount(rows[rows >= 0], minlength=len(popularity))
+    songs.append(songs_fp, header, new_songs, popularity=popularity)
+    EncodingTable.append(os.path.join(args.cache, 'songs.table'), new_songs,
+        lambda id: data.encode_song.sparse(*new_songs[id]))
+    print('{} new songs'.format(len(new_songs)))
+
+    # Playlists and points.
+    split = 'training' if args.split == 'train' else 'testing'
+    appended, new_playlists = append_datapoints(os.path.join(args.cache, split), header,
+        records, song_index, users, args.min_playlist_len, args.max_playlist_len)
+    print('{} records appended out of {} ({} new playlists)'.format(appended,
+        len(records['msno']), new_playlists))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Appends new interaction records to the cache.')
+
+    # ~ data processing
+    add_arguments(parser)
+
+    # ~ ingest params
+    parser.add_argument('--interactions', metavar='PATH', type=str, required=True,
+        help='Csv file of the new records, with the msno, song_id and source_system_tab columns.')
+    parser.add_argument('--split', choices=('train', 'test'), default='train',
+        help='Set the records are appended to, only training records count as plays.')
+    parser.add_argument('--songs', metavar='PATH', type=str, default=None,
+        help='Csv file of new songs, in the format of songs.csv.')
+    parser.add_argument('--members', metavar='PATH', type=str, default=None,
+        help='Csv file of new users, in the format of members.csv.')
+
+    args = parser.parse_args()
+    ingest(args)
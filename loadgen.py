@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import asyncio, json, time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from pipeline import add_arguments, load_data
+from utils.http import read_message, write_message
+
+"""
+Load generator of the scoring server (serve.py): concurrent clients send POST /score requests
+built from the playlists of the cache, over keep-alive connections, and the client-side
+latency percentiles and throughput are reported along with the server's /metrics.
+"""
+
+def make_requests(data, n, split='test', history_len=50, candidates=0, k=10, seed=0):
+    """
+    Returns n requests of random users of the split: a random prefix of the user's playlist
+    (at most history_len songs) as history, and `candidates` random songs to score, or the
+    top-k of the catalogue if 0.
+    """
+    rng = np.random.default_rng(seed)
+    playlist = data.train_playlist if split == 'train' else data.test_playlist
+    ids, behavior_vocab = data.song_table.ids, playlist.behavior_vocab
+    requests = []
+    for row in rng.integers(0, len(playlist.users), n):
+        songs, behaviors = playlist.rows(playlist.users[row])
+        end = int(rng.integers(1, len(songs) + 1))
+        start = max(0, end - history_len)
+        request = {'user': str(playlist.users[row]), 'history': ids[songs[start:end]].tolist(),
+            'behaviors': behavior_vocab[behaviors[start:end]].tolist(), 'k': k}
+        if candidates:
+            request['candidates'] = ids[rng.integers(0, len(ids), candidates)].tolist()
+        requests.append(request)
+    return requests
+
+async def get(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    write_message(writer, 'GET {} HTTP/1.1'.format(path), headers={'Connection': 'close'})
+    await writer.drain()
+    _, _, body = await read_message(reader)
+    writer.close()
+    return json.loads(body)
+
+async def client(host, port, requests, latencies, statuses):
+    """Sends the requests one after the other over a single connection."""
+    reader, writer = await asyncio.open_connection(host, port)
+    for request in requests:
+        start = time.perf_counter()
+        write_message(writer, 'POST /score HTTP/1.1', request)
+        await writer.drain()
+        status_line, _, _ = await read_message(reader)
+        latencies.append(time.perf_counter() - start)
+        statuses.append(int(status_line.split(' ')[1]))
+    writer.close()
+
+async def run(host, port, requests, concurrency):
+    """Sends the requests over `concurrency` connections, returns the client-side report."""
+    latencies, statuses = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, requests[i::concurrency], latencies, statuses)
+        for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(statuses),
+        'errors': sum(status != 200 for status in statuses),
+        'throughput': len(statuses) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'server': await get(host, port, '/metrics'),
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Puts the scoring server (serve.py) under load.')
+
+    # ~ data processing
+    add_arguments(parser)
+
+    # ~ load params
+    parser.add_argument('--host', metavar='HOST', type=str, default='127.0.0.1',
+        help='Address of the server.')
+    parser.add_argument('--port', metavar='NB', type=int, default=8080,
+        help='Port of the server.')
+    parser.add_argument('--requests', metavar='NB', type=int, default=1000,
+        help='Total number of requests sent.')
+    parser.add_argument('--concurrency', metavar='NB', type=int, default=16,
+        help='Number of concurrent connections, each sending one request at a time.')
+    parser.add_argument('--split', choices=('train', 'test'), default='test',
+        help='Set from which the users and their histories are taken.')
+    parser.add_argument('--history-len', metavar='NB', type=int, default=50,
+        help='Maximum number of history songs per request.')
+    parser.add_argument('--candidates', metavar='NB', type=int, default=0,
+        help='Number of random candidate songs to score per request, 0 for the top-K of the '
+            'whole catalogue.')
+    parser.add_argument('--k', metavar='NB', type=int, default=10,
+        help='Number of songs returned per request.')
+    parser.add_argument('--seed', metavar='NB', type=int, default=0,
+        help='Seed of the generated requests.')
+
+    args = parser.parse_args()
+
+    data = load_data(args)
+    requests = make_requests(data, args.requests, args.split, args.history_len, args.candidates,
+        args.k, args.seed)
+    print(json.dumps(asyncio.run(run(args.host, args.port, requests, args.concurrency)),
+        indent=2))
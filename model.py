@@ -1,54 +1,208 @@
-from statistics import mean
+import os
+from contextlib import nullcontext
 
 import torch
 import torch.nn as nn
 from torch.nn import Module, Linear
 from tqdm import tqdm
 
-from utils.nn import MLP, RNN
+from utils.nn import Bags, Indexed, MLP, RNN
+from utils import distributed
+from utils.fastmath import autocast
 
 class DTNMRWrapper:
-    """Runner wrapper for the DTNMR model."""
+    """
+    Runner wrapper for the DTNMR model. In distributed training, model is wrapped in a
+    DistributedDataParallel and each rank iterates over its shard of the data: the metrics are
+    aggregated over the ranks and only rank 0 reports them.
+
+    Training can be checkpointed (see checkpoint) and resumed from any step (see restore): the
+    batch samplers are expected to be dataset.BucketBatchSampler with a seed.
+    """
 
-    def __init__(self, model, train_dl, valid_dl, optimizer):
+    def __init__(self, model, train_dl, valid_dl, optimizer, evaluator=None, profiler=None,
+        dtype=torch.float32):
         """
         Parameters
         ---
-            model: torch.nn.Model, The recommendation model to train.
+            model: torch.nn.Model, The recommendation model to train, optionally wrapped in a
+                torch.nn.parallel.DistributedDataParallel
             train_dl: torch.utils.data.DataLoader, the training data loader
             valid_dl: torch.utils.data.DataLoader, the validation data loader
             optimizer: torch.optim, the optimizer used for back-propagation
+            evaluator: evaluate.Evaluator, computes ranking metrics on the validation set
+            profiler: utils.profiling.StepProfiler, times the stages of the training steps
+            dtype: compute dtype of the forward passes, see utils.fastmath.autocast, the
+                batches are expected in this dtype
         """
         self.model = model
         self.train_dl = train_dl
         self.valid_dl = valid_dl
         self.optimizer = optimizer
+        self.evaluator = evaluator
+        self.profiler = profiler
+        self.dtype = dtype
         self.criterion = nn.CrossEntropyLoss()
+        self.epoch, self.step = 0, 0 # position of the next training step
+        self.best = None # best value of the checkpointing metric so far
+        self.history = [] # validation metrics of the epochs trained by this wrapper
+
+    def train(self, epochs, checkpoint_dir=None, every=None, metric='loss'):
+        """
+        Trains the model up to the given number of epochs, resuming from the current position.
+
+        Parameters
+        ---
+        checkpoint_dir: string
+            Directory where `last.pt` is saved after each epoch and every `every` steps, and
+            `best.pt` each time the validation `metric` improves. Nothing is saved by default.
+        every: int
+            Number of steps between periodic checkpoints, only at the end of epochs by default.
+        metric: string
+            Validation metric of the best checkpoint, the loss is minimized, others maximized.
+        """
+        main = distributed.is_main()
+        last = best = None
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            last, best = (os.path.join(checkpoint_dir, f) for f in ('last.pt', 'best.pt'))
 
-    def train(self, epochs):
-        for epoch in range(epochs):
-            print('Epoch %i/%i' % (epoch+1, epochs))
-            losses, accuracies = self.train_epoch()
-            print('summary of epoch: average loss={:.2f}, average accuracy={:.2f}' \
-                .format(mean(losses), mean(accuracies)))
+        while self.epoch < epochs:
+            self.train_dl.batch_sampler.set_epoch(self.epoch, start=self.step)
+            self.valid_dl.batch_sampler.set_epoch(self.epoch)
+            if main:
+                print('Epoch %i/%i' % (self.epoch+1, epochs))
+            losses, accuracies = self.train_epoch(last, every)
+            loss, accuracy, n = distributed.all_reduce(sum(losses), sum(accuracies), len(losses))
+            self.epoch, self.step = self.epoch + 1, 0
+            metrics = self.validate()
+            self.history.append(metrics)
+            if main:
+                print('summary of epoch: average loss={:.2f}, average accuracy={:.2f}' \
+                    .format(loss/max(n, 1), accuracy/max(n, 1)))
+                if self.profiler is not None:
+                    print('steps: ' + ' - '.join('{}={:.4g}'.format(name, value)
+                        for name, value in self.profiler.summary().items()))
+                print('validation: ' + ' - '.join('{}={:.4f}'.format(name, value)
+                    for name, value in metrics.items()))
 
-    def train_epoch(self):
-        """Runs the training on the whole training set."""
+            if checkpoint_dir:
+                # Every rank takes part in checkpoint, metrics are only known to rank 0.
+                value = distributed.broadcast(metrics.get(metric))
+                sign = -1 if metric == 'loss' else 1
+                improved = value is not None and (self.best is None or sign*value > sign*self.best)
+                if improved:
+                    self.best = float(value)
+                self.checkpoint(last)
+                if improved:
+                    self.checkpoint(best)
+
+    def checkpoint(self, fp):
+        """
+        Saves the model, the optimizer, the training position and the random states of the
+        ranks in fp. It is a collective call in distributed training, rank 0 writes the file.
+        The file can also be loaded with DTNMR.load.
+        """
+        sampler = getattr(self.train_dl.dataset, 'sampler', None)
+        rng = distributed.gather({'torch': torch.get_rng_state(),
+            'sampler': sampler.rng.bit_generator.state if sampler else None})
+        if not distributed.is_main():
+            return
+        torch.save({
+            'config': self.module.config,
+            'state_dict': self.module.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'epoch': self.epoch,
+            'step': self.step,
+            'best': self.best,
+            'batch_seed': self.train_dl.batch_sampler.seed,
+            'rng': rng,
+        }, fp + '.tmp')
+        os.replace(fp + '.tmp', fp) # a crash while saving leaves the previous checkpoint intact
+
+    def restore(self, checkpoint):
+        """
+        Restores the state saved by `checkpoint`, training then continues from the saved step.
+        The random states are only restored with the same number of ranks. Only the negative
+        sampler of the training process is saved: DataLoader workers reseed their own copy (see
+        dataset.seed_worker), so resuming is only exact with num_workers=0.
+        """
+        self.module.load_state_dict(checkpoint['state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        self.epoch, self.step = checkpoint['epoch'], checkpoint['step']
+        self.best = checkpoint['best']
+        for dl in (self.train_dl, self.valid_dl):
+            dl.batch_sampler.seed = checkpoint['batch_seed']
+
+        rng = checkpoint['rng']
+        if len(rng) == distributed.world_size():
+            rng = rng[distributed.rank()]
+            torch.set_rng_state(rng['torch'])
+            sampler = getattr(self.train_dl.dataset, 'sampler', None)
+            if sampler and rng['sampler']:
+                sampler.rng.bit_generator.state = rng['sampler']
+
+    @property
+    def module(self):
+        """The DTNMR model, unwrapped from DistributedDataParallel."""
+        return getattr(self.model, 'module', self.model)
+
+    def validate(self):
+        """
+        Runs the model on the validation set, returns the average loss and accuracy on the
+        sampled subsets along with the ranking metrics of the evaluator, if any. The ranking
+        metrics are only computed by rank 0.
+        """
+        model = self.module
+        model.eval()
+        losses, accuracies = [], []
+        with torch.inference_mode(), autocast(self.dtype):
+            for x in tqdm(self.valid_dl, desc='validation', disable=not distributed.is_main()):
+                y_hat = model(*x)
+                y = torch.zeros(y_hat.shape[0], dtype=torch.long)
+                losses.append(self.criterion(y_hat, y).item())
+                accuracies.append((torch.argmax(y_hat, dim=1) == 0).float().mean().item())
+        loss, accuracy, n = distributed.all_reduce(sum(losses), sum(accuracies), len(losses))
+        metrics = {'loss': loss / max(n, 1), 'accuracy': accuracy / max(n, 1)}
+        if self.evaluator is not None and distributed.is_main():
+            with autocast(self.dtype):
+                metrics.update(self.evaluator(model))
+        model.train()
+        return metrics
+
+    def train_epoch(self, checkpoint=None, every=None):
+        """
+        Runs the training on the whole training set, or on the rank's shard of it, from the
+        current step. Every `every` steps, the training state is saved in file checkpoint.
+        """
         losses, accuracies = [], []
-        for i, x in (t := tqdm(enumerate(self.train_dl), total=len(self.train_dl))):
-            y = torch.zeros((x[0].shape[0],1), dtype=torch.long) #? add , 1) if necessary
-            y_hat = self.model(*x)
+        profiler = self.profiler
+        batches = profiler.iterate(self.train_dl, self.epoch) if profiler else self.train_dl
+        stage = profiler.stage if profiler else lambda name: nullcontext()
+        for x in (t := tqdm(batches, total=len(self.train_dl),
+            disable=not distributed.is_main())):
+            with stage('forward'), autocast(self.dtype):
+                y_hat = self.model(*x)
+                y = torch.zeros(y_hat.shape[0], dtype=torch.long) # the label is always 1st
+                loss = self.criterion(y_hat, y)
 
-            self.optimizer.zero_grad()
-            loss = self.criterion(y_hat, y)
-            loss.backward()
-            self.optimizer.step()
+            with stage('backward'):
+                self.optimizer.zero_grad()
+                loss.backward() # DistributedDataParallel averages the gradients over the ranks
+            with stage('step'):
+                self.optimizer.step()
+            self.step += 1
 
             loss = loss.item()
+            if profiler:
+                profiler.end_step(len(y), loss)
             accuracy = (torch.argmax(y_hat, dim=1) == 0).float().mean().item()
             losses.append(loss)
             accuracies.append(accuracy)
             t.set_description("loss %.2f - accuracy %.2f%%" % (loss, accuracy*100))
+
+            if checkpoint and every and self.step % every == 0:
+                self.checkpoint(checkpoint)
         return losses, accuracies
 
 
@@ -65,43 +219,129 @@ class DTNMR(Module):
             rating = RC(user_embedding, song_embedding)
     """
 
-    def __init__(self, user_mhe_size, song_mhe_size, behavior_mhe_size, st_playlist_len, emb_size):
-        """Given the entity encoding sizes, it will construct the different components."""
+    def __init__(self, user_mhe_size, song_mhe_size, behavior_mhe_size, st_playlist_len, emb_size,
+        sparse=False, hashing=None):
+        """
+        Given the entity encoding sizes, it will construct the different components. With
+        `sparse`, users and songs are expected as utils.nn.Bags rather than dense encodings.
+        hashing, the parameters of the hashed features (see pipeline.Data), is only recorded in
+        the config: encodings of the same sizes but hashed differently don't match either.
+        """
         super(DTNMR, self).__init__()
         self.user_mhe_size = user_mhe_size
         self.song_mhe_size = song_mhe_size
         self.emb_size = emb_size
         self.song_emb_size = emb_size + behavior_mhe_size
         self.st_playlist_len = st_playlist_len
+        self.sparse = sparse
+        self.config = dict(user_mhe_size=user_mhe_size, song_mhe_size=song_mhe_size,
+            behavior_mhe_size=behavior_mhe_size, st_playlist_len=st_playlist_len,
+            emb_size=emb_size, sparse=sparse, hashing=hashing or {})
 
-        self.USFC = MLP(self.user_mhe_size, n_1=512, n_2=64, n_out=emb_size)
-        self.MFC = MLP(self.song_mhe_size, n_1=512, n_2=64, n_out=emb_size)
+        self.USFC = MLP(self.user_mhe_size, n_1=512, n_2=64, n_out=emb_size, sparse=sparse)
+        self.MFC = MLP(self.song_mhe_size, n_1=512, n_2=64, n_out=emb_size, sparse=sparse)
         self.UDFC = RNN(self.song_emb_size, num_layers=2, n_hidden=256, n_out=emb_size)
         self.RC = Linear(2*emb_size, 1)
 
-    def forward(self, user, playlist, behaviors, subset):
+    def forward(self, user, playlist, behaviors, subset, lengths=None):
         """
         The forward pass of the model is the calculation of the rating between the user and
-        each song in the subset. The result is the list [Score(u, s) for s in subset].
+        each song in the subset. The result is the (batch, subset) tensor of Score(u, s).
+
+        Inputs are batched as returned by dataset.collate: user is (batch, user_mhe), playlist
+        (seq, batch, song_mhe), behaviors (seq, batch, behavior_mhe) and subset (batch, subset,
+        song_mhe). In sparse mode user, playlist and subset are utils.nn.Bags of these shapes.
+        Playlists are right-padded, lengths (batch,) gives their actual size (default: seq).
+        Playlist and subset can also be utils.nn.Indexed, as returned by dataset.DedupCollate.
+        """
+        # Songs of the playlist and of the subset are embedded together in a single MFC call.
+        latent_playlist, embeddings = self.embed_songs(playlist, subset)
+
+        user_feature = self.user_feature(user, latent_playlist, behaviors, lengths)
+        return self.rate(user_feature, embeddings)
+
+    def user_feature(self, user, latent_playlist, behaviors, lengths=None):
+        """
+        Combined user embedding (batch, emb_size), computed from the user encoding and the MFC
+        embeddings of the songs of its right-padded playlist (seq, batch, emb_size).
         """
+        if lengths is None:
+            lengths = torch.full((latent_playlist.shape[1],), latent_playlist.shape[0],
+                dtype=torch.long)
+
         # User static feature embedding.
-        user_static = self.USFC(user.float())
+        user_static = self.USFC(user)
 
         # User dynamic feature embedding.
-        latent_playlist = torch.stack([self.MFC(s.float()) for s in playlist])
-        behaviors = torch.stack([b.float() for b in behaviors])
         Lt_playlist = torch.cat([latent_playlist, behaviors], dim=2)
-        st_playlist = Lt_playlist[-self.st_playlist_len:]
-        user_dynamic = self.UDFC(Lt_playlist) + self.UDFC(st_playlist)
+        st_playlist, st_lengths = self.suffix(Lt_playlist, lengths, self.st_playlist_len)
+
+        # Long-term and short-term windows are packed in a single UDFC call: (seq, 2*batch).
+        Lt_dynamic, st_dynamic = self.UDFC(torch.cat([Lt_playlist, st_playlist], dim=1),
+            torch.cat([lengths, st_lengths])).chunk(2)
+        user_dynamic = Lt_dynamic + st_dynamic
 
         # User feature combined embedding.
-        user_feature = user_static + user_dynamic
+        return user_static + user_dynamic
+
+    def rate(self, user_feature, embeddings):
+        """Rates the (batch, subset, emb_size) song embeddings, all candidates in one RC call."""
+        combined = torch.cat([user_feature.unsqueeze(1).expand_as(embeddings), embeddings], dim=2)
+        return self.RC(combined).squeeze(2)
 
-        # Rating evaluation on song subset.
-        ratings = []
-        for song in subset:
-            embedding = self.MFC(song.float())
-            combined = torch.cat([user_feature, embedding], dim=1)
-            ratings.append(self.RC(combined))
+    def save(self, fp):
+        """Saves the weights along with the parameters needed to construct the model again."""
+        torch.save({'config': self.config, 'state_dict': self.state_dict()}, fp)
 
-        return torch.stack(ratings, dim=1)
+    @classmethod
+    def load(cls, fp, **sizes):
+        """
+        Loads a model saved by `save`, or a training checkpoint. Encoding sizes given as
+        keywords (e.g. song_mhe_size=len(encode_song)) are checked against the saved ones.
+        """
+        saved = torch.load(fp)
+        cls.check(saved['config'], **sizes)
+        model = cls(**saved['config'])
+        model.load_state_dict(saved['state_dict'])
+        return model
+
+    @staticmethod
+    def check(config, **sizes):
+        """
+        Raises a ValueError if the encoding sizes or hashing parameters of config differ from
+        the given ones. Models saved before hashing was recorded are only checked for sizes.
+        """
+        wrong = {name: (config[name], size) for name, size in sizes.items()
+            if name in config and config[name] != size}
+        if wrong:
+            raise ValueError('model and data encodings do not match, ' + ', '.join(
+                '{}: {} != {}'.format(name, *values) for name, values in wrong.items()))
+
+    @staticmethod
+    def suffix(X, lengths, n):
+        """
+        Returns the last n steps of each right-padded sequence of X, and their lengths. The
+        result is right-padded to the same number of steps as X.
+        """
+        suffix_lengths = lengths.clamp(max=n)
+        steps = torch.arange(X.shape[0]).unsqueeze(1) + (lengths - suffix_lengths)
+        steps = steps.clamp(max=X.shape[0] - 1) # padding steps past the end of the sequence
+        return X.gather(0, steps.unsqueeze(2).expand(-1, -1, X.shape[2])), suffix_lengths
+
+    def embed_songs(self, playlist, subset):
+        """
+        Runs MFC over the playlist and subset songs at once, returns both embeddings. Given
+        utils.nn.Indexed songs, MFC only runs over the unique songs of the batch, which are
+        then gathered: the gradients of the repeated songs add up through the gather.
+        """
+        if isinstance(subset, Indexed):
+            embeddings = self.MFC(subset.songs)
+            return embeddings[playlist.index], embeddings[subset.index]
+        seq_len, batch_size = playlist.shape[:2]
+        if self.sparse:
+            songs = Bags.cat([playlist, subset])
+        else:
+            songs = torch.cat([playlist.flatten(0, 1), subset.flatten(0, 1)])
+        embeddings = self.MFC(songs)
+        return (embeddings[:seq_len*batch_size].view(seq_len, batch_size, -1),
+            embeddings[seq_len*batch_size:].view(*subset.shape[:2], -1))
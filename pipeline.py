@@ -0,0 +1,170 @@
+import os
+from argparse import ArgumentTypeError
+from typing import NamedTuple
+
+from utils.misc import get
+from utils.dumper import StaleCacheError
+from utils.table import EncodingTable
+from processing import process_training, process_songs, process_users, construct_datapoints
+from cache import save_cache, load_cache, SONG_FEATURES, USER_FEATURES
+from encoding import UserEncoder, SongEncoder, BehaviorEncoder
+
+"""Data pipeline shared by the command line tools: csv processing, cache loading and encoders."""
+
+# Columns read from the csv files, they are all dictionary-encoded (see utils.misc.get): the
+# processing handles each distinct value only once.
+INTERACTION_COLUMNS = ('msno', 'song_id', 'source_system_tab')
+SONG_COLUMNS = ('song_id', 'song_len', 'genre_ids', 'artist_name', 'composer', 'language')
+USER_COLUMNS = ('msno', 'bd', 'gender', 'city')
+
+# Categorical features which can be hashed, see encoding.categorical.
+HASHED_FEATURES = SONG_FEATURES[1:] + USER_FEATURES + ('behavior',)
+
+class Data(NamedTuple):
+    songs: object
+    users: object
+    train_points: object
+    train_playlist: object
+    test_points: object
+    test_playlist: object
+    encode_song: SongEncoder
+    encode_user: UserEncoder
+    encode_behavior: BehaviorEncoder
+    song_table: EncodingTable
+    hashing: dict # [buckets, signed, min_count] of each hashed feature
+
+    def sizes(self):
+        """The encoding sizes and hashing parameters, as expected by model.DTNMR."""
+        return dict(user_mhe_size=len(self.encode_user), song_mhe_size=len(self.encode_song),
+            behavior_mhe_size=len(self.encode_behavior), hashing=self.hashing)
+
+
+def add_arguments(parser):
+    """Adds the data processing arguments to an ArgumentParser."""
+    parser.add_argument('--reload', action='store_true', default=False,
+        help='Add flag to force the initial data extraction and pre-processing from .csv files.')
+    parser.add_argument('--top', metavar='RATIO', type=float, default=0.001,
+        help='Will only keep the songs among the RATIO in popularity.')
+    parser.add_argument('--min-playlist-len', metavar='NB', type=int, default=20,
+        help='Minimum admissible playlist size, all users with a lower number will be left out.')
+    parser.add_argument('--max-playlist-len', metavar='NB', type=int, default=200,
+        help='Maximum admissible playlist size, all users with a higher number will be left out.')
+    parser.add_argument('--db', metavar='PATH', type=str, default='../db',
+        help='Directory where the WSDM-KKBOX csv files are located.')
+    parser.add_argument('--cache', metavar='PATH', type=str, default='data',
+        help='Directory where the processed data is or will be saved.')
+    parser.add_argument('--hash', metavar='FEATURE=BUCKETS', type=hash_argument, action='append',
+        default=[], help='Encodes a categorical feature ({}) with BUCKETS hashed bits instead of '
+            'one bit per value, can be repeated.'.format(', '.join(HASHED_FEATURES)))
+    parser.add_argument('--hash-signed', action='store_true', default=False,
+        help='Add flag to hash values to +1 or -1 so that colliding values cancel out.')
+    parser.add_argument('--hash-min-count', metavar='NB', type=int, default=None,
+        help='Values of hashed features occurring less than NB times are left out.')
+
+
+def hash_argument(value):
+    """Parses a FEATURE=BUCKETS --hash argument into a (feature, buckets) pair."""
+    name, _, buckets = value.partition('=')
+    if name not in HASHED_FEATURES or not buckets.isdigit() or int(buckets) < 1:
+        raise ArgumentTypeError('expected FEATURE=BUCKETS with FEATURE among {}, got {}'.format(
+            ', '.join(HASHED_FEATURES), value))
+    return name, int(buckets)
+
+
+def build_cache(args, header):
+    """Initial data extraction from the csv files, processing and saving in args.cache."""
+    assert(os.path.isdir(args.db))
+    os.makedirs(args.cache, exist_ok=True)
+
+    # Training data
+    train_headers, train = get(os.sep.join((args.db, 'train.csv')),
+        columns=INTERACTION_COLUMNS, categorical=INTERACTION_COLUMNS)
+    popularity, most_popular = process_training(train)
+
+    # Songs
+    song_headers, songs_csv = get(os.sep.join((args.db, 'songs.csv')),
+        columns=SONG_COLUMNS, categorical=SONG_COLUMNS)
+    songs, *song_sets = process_songs(songs_csv, popularity, most_popular, top=args.top)
+
+    # Users
+    user_headers, users_csv = get(os.sep.join((args.db, 'members.csv')),
+        columns=USER_COLUMNS, categorical=USER_COLUMNS)
+    users, *user_sets = process_users(users_csv)
+
+    # Actual data train/test data points
+    test_headers, test = get(os.sep.join((args.db, 'test.csv')),
+        columns=INTERACTION_COLUMNS, categorical=INTERACTION_COLUMNS)
+    training = construct_datapoints(train, users, songs,
+        min_len=args.min_playlist_len, max_len=args.max_playlist_len)
+    testing = construct_datapoints(test, users, songs,
+        min_len=args.min_playlist_len, max_len=args.max_playlist_len)
+
+    save_cache(args.cache, header, (songs, *song_sets), (users, *user_sets), training, testing,
+        popularity)
+
+
+def cache_header(args):
+    """The processing parameters recorded in the cache, see utils.dumper."""
+    return {'top': args.top, 'min_playlist_len': args.min_playlist_len,
+        'max_playlist_len': args.max_playlist_len}
+
+
+def load_data(args):
+    """Loads the cache, (re)building it if needed, and initializes the encoders."""
+    ## Initial load, processing and saving
+    # The cache is rebuilt whenever it was produced with other processing parameters.
+    header = cache_header(args)
+    reload = args.reload
+    try:
+        if reload:
+            raise StaleCacheError('reload requested')
+        cache = load_cache(args.cache, header)
+    except (FileNotFoundError, StaleCacheError) as e:
+        print('building cache ({})'.format(e))
+        build_cache(args, header)
+        cache = load_cache(args.cache, header)
+        reload = True # derived caches must be rebuilt as well
+
+    ## Loading processed data and encoding
+    (songs, *song_sets), (users, *user_sets), training, testing = cache
+    train_points, train_playlist, behaviors = training
+    test_points, test_playlist, _ = testing
+
+    # Hashed features, value counts are only needed for the frequency cutoff.
+    buckets = dict(args.hash)
+    def hashing(name, counts):
+        if name in buckets:
+            return dict(buckets=buckets[name], signed=args.hash_signed,
+                min_count=args.hash_min_count, counts=counts() if args.hash_min_count else None)
+
+    # Songs
+    encode_song = SongEncoder(*song_sets, hashing={name: hashing(name, lambda: songs.counts(name))
+        for name in SONG_FEATURES[1:]})
+    hashed = {name: [buckets[name], args.hash_signed, args.hash_min_count]
+        for name in HASHED_FEATURES if name in buckets}
+    song_hashing = {name: hashed[name] for name in SONG_FEATURES[1:] if name in hashed}
+
+    # Song encodings are computed once and read from a memory-mapped table afterwards.
+    table_fp = os.sep.join((args.cache, 'songs.table'))
+    try:
+        song_table = EncodingTable(table_fp)
+        stale = reload or len(song_table) != len(songs) or song_table.width != len(encode_song) \
+            or song_table.meta.get('hashing', {}) != song_hashing
+    except FileNotFoundError:
+        stale = True
+    if stale:
+        print('building song encoding table...')
+        EncodingTable.build(table_fp, songs.keys(), lambda id: encode_song.sparse(*songs[id]),
+            width=len(encode_song), hashing=song_hashing)
+        song_table = EncodingTable(table_fp)
+
+    # Users
+    encode_user = UserEncoder(*user_sets, encode_song, hashing={name: hashing(name,
+        lambda: users.counts(name)) for name in USER_FEATURES})
+
+    # Behaviors
+    encode_behavior = BehaviorEncoder(behaviors,
+        hashing('behavior', train_playlist.behavior_counts))
+
+    return Data(songs, users, train_points, train_playlist, test_points, test_playlist,
+        encode_song, encode_user, encode_behavior, song_table, hashed)
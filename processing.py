@@ -1,24 +1,25 @@
 import os, pickle
-from utils.process import process, no_special_character
+
+import numpy as np
+
+from utils.process import factorize, process, no_special_character
 
 def process_training(train):
-    popularity = {}
-    most_popular = 0
-    for user, song in zip(train['msno'], train['song_id']):
-        popularity[song] = popularity[song]+1 if song in popularity else 1
-        if (popularity[song] > most_popular):
-            most_popular = popularity[song]
-    return popularity, most_popular
+    """Counts the number of plays of each song, `song_id` is expected to be a Categorical."""
+    songs = train['song_id']
+    counts = np.bincount(songs.codes, minlength=len(songs.categories))
+    popularity = dict(zip(songs.categories.tolist(), counts.tolist()))
+    return popularity, int(counts.max(initial=0))
 
 
 def process_songs(songs, popularity, most_popular, top):
     print('processing songs...')
 
-    indices = {x: i for i, x in enumerate(songs['song_id'])}
-    ids = songs['song_id']
+    ids, id_values = factorize(songs['song_id'])
+    alive = np.ones(len(id_values), dtype=bool)
 
     def process_feature(data, transform=lambda x: x, policy=lambda x: True):
-        return process(data, songs['song_id'], indices, transform, policy)
+        return process(data, ids, alive, transform, policy)
 
     # Tag songs by going through the feature values one feature at a time.
     _, __ = process_feature(songs['song_id'],
@@ -33,36 +34,53 @@ def process_songs(songs, popularity, most_popular, top):
         transform=lambda x: x.strip(), policy=no_special_character)
     language, language_set = process_feature(songs['language'])
 
-    songs = {id: data for id, *data in zip(ids, length, genre, artist, composer, language)
-        if indices[id] != -1}
-    return songs, {max(length_set)}, genre_set, artist_set, composer_set, language_set
+    features = (length, genre, artist, composer, language)
+    songs = {id_values[ids[i]]: [feature[i] for feature in features]
+        for i in np.flatnonzero(alive[ids])}
+    return songs, {max(length_set, default=0)}, genre_set, artist_set, composer_set, language_set
 
 
 def process_users(users):
     print('processing users...')
 
-    indices = {x: i for i, x in enumerate(users['msno'])}
+    ids, id_values = factorize(users['msno'])
+    alive = np.ones(len(id_values), dtype=bool)
 
     def process_feature(data, transform=lambda x: x, policy=lambda x: True):
-        return process(data, users['msno'], indices, transform, policy)
+        return process(data, ids, alive, transform, policy)
 
     age, age_set = process_feature(users['bd'], policy=lambda x: 15 < int(x) and int(x) < 60)
     gender, gender_set = process_feature(users['gender'])
     city, city_set = process_feature(users['city'])
 
-    users = {id: data for id, *data in zip(users['msno'], age, gender, city) if indices[id] != -1}
+    users = {id_values[ids[i]]: [feature[i] for feature in (age, gender, city)]
+        for i in np.flatnonzero(alive[ids])}
     return users, age_set, gender_set, city_set
 
 
 def construct_datapoints(data, users, songs, min_len, max_len):
     print('constructing set of records...')
+    user_codes, user_values = factorize(data['msno'])
+    song_codes, song_values = factorize(data['song_id'])
+    behavior_codes, behavior_values = factorize(data['source_system_tab'])
+
+    # Keep the records of known users and songs, grouped by user in order of first appearance.
+    known_users = np.fromiter((u in users for u in user_values), bool, len(user_values))
+    known_songs = np.fromiter((s in songs for s in song_values), bool, len(song_values))
+    rows = np.flatnonzero(known_users[user_codes] & known_songs[song_codes])
+    _, first = np.unique(user_codes[rows], return_index=True)
+    rank = np.empty(len(user_values), dtype=np.int64)
+    rank[user_codes[rows[np.sort(first)]]] = np.arange(len(first))
+    rows = rows[np.argsort(rank[user_codes[rows]], kind='stable')]
+    bounds = np.flatnonzero(np.diff(user_codes[rows], prepend=-1, append=-1))
 
     # Construct the playlist dictionnary {user_id: (song_id[], behavior)} ; behavior set.
-    playlist, behaviors = {}, set()
-    for user, song, behavior in zip(data['msno'], data['song_id'], data['source_system_tab']):
-        if user in users and song in songs:
-            behaviors.add(behavior)
-            playlist.setdefault(user, []).append((song, behavior))
+    song_column = song_values[song_codes[rows]]
+    behavior_column = behavior_values[behavior_codes[rows]]
+    behaviors = set(behavior_values[np.unique(behavior_codes[rows])].tolist())
+    playlist = {user_values[user_codes[rows[start]]]:
+        list(zip(song_column[start:end].tolist(), behavior_column[start:end].tolist()))
+        for start, end in zip(bounds[:-1], bounds[1:])}
 
     # Construct the list of training points (user, song).
     points = []
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from pipeline import add_arguments, load_data
+from dataset import MRSDataset, collate_songs, collate_users
+from model import DTNMR
+
+def embed_catalogue(model, song_table, batch_size=4096):
+    """Runs MFC over every song of the table, returns a contiguous (n_songs, emb_size) matrix."""
+    embeddings = np.empty((len(song_table), model.emb_size), dtype=np.float32)
+    with torch.inference_mode():
+        for start in range(0, len(song_table), batch_size):
+            rows = np.arange(start, min(start + batch_size, len(song_table)))
+            embeddings[rows] = model.MFC(collate_songs(song_table, rows, model.sparse)).float() \
+                .numpy() # float32 under autocast as well
+    return embeddings
+
+def top_k(scores, k):
+    """Returns the (indices, scores) of the k highest scores of each row, in decreasing order."""
+    k = min(k, scores.shape[1])
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class FlatIndex:
+    """
+    Exact maximum inner product search over the rows of an (n_items, dim) matrix. Queries are
+    an (n_queries, dim) matrix, or a single (1, dim) query shared by all users which then only
+    differ by their bias and excluded items.
+    """
+
+    def __init__(self, items):
+        self.items = np.ascontiguousarray(items, dtype=np.float32)
+
+    def search(self, queries, k, bias, exclude=None):
+        """
+        Returns the (items, scores) of the k best items for each user, the score being
+        queries·item + bias. Parameter exclude is a list of item arrays to leave out per user.
+        """
+        scores = queries @ self.items.T + bias[:, None]
+        for i, rows in enumerate(exclude or ()):
+            scores[i, rows] = -np.inf
+        return top_k(scores, k)
+
+
+class IVFIndex(FlatIndex):
+    """
+    Approximate search (inverted file index): items are clustered with k-means, a query only
+    scans the items of the n_probe clusters whose centroid has the highest inner product.
+    Suitable for catalogues in the millions, where scoring every item is too costly.
+    """
+
+    def __init__(self, items, n_lists=1024, n_probe=16, n_iter=10, seed=0):
+        super().__init__(items)
+        self.n_probe = n_probe
+        rng = np.random.default_rng(seed)
+        n_lists = min(n_lists, len(self.items))
+        self.centroids = self.items[rng.choice(len(self.items), n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = self.assign(self.items)
+            counts = np.bincount(assignment, minlength=n_lists)
+            sums = np.stack([np.bincount(assignment, weights=column, minlength=n_lists)
+                for column in self.items.T], axis=1)
+            nonempty = counts > 0
+            self.centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        assignment = self.assign(self.items)
+        self.lists = np.argsort(assignment, kind='stable')
+        self.offsets = np.searchsorted(assignment[self.lists], np.arange(n_lists + 1))
+
+    def assign(self, X, chunk_size=1 << 16):
+        """Index of the nearest centroid (L2) of each row of X."""
+        norms = (self.centroids**2).sum(axis=1)
+        return np.concatenate([np.argmin(norms - 2 * X[i:i + chunk_size] @ self.centroids.T, axis=1)
+            for i in range(0, len(X), chunk_size)])
+
+    def search(self, queries, k, bias, exclude=None):
+        probes, _ = top_k(queries @ self.centroids.T, self.n_probe)
+        items, scores = [], []
+        for i in range(len(bias)):
+            probe = probes[min(i, len(probes) - 1)]
+            candidates = np.concatenate([self.lists[self.offsets[c]:self.offsets[c+1]]
+                for c in probe])
+            if exclude is not None:
+                candidates = candidates[~np.isin(candidates, exclude[i])]
+            score = self.items[candidates] @ queries[min(i, len(queries) - 1)] + bias[i]
+            best, best_scores = top_k(score[None], k)
+            items.append(candidates[best[0]])
+            scores.append(best_scores[0])
+        return items, scores
+
+
+class Recommender:
+    """
+    Top-K recommendation over the whole catalogue. RC being linear over the concatenation
+    [user_feature, embedding], the score decomposes into
+        Score(u, s) = w_user·user_feature(u) + w_song·embedding(s) + b
+    Song embeddings are computed once and stored in the index, a batch of users is then
+    scored with a single matrix product (the query being w_song, the bias w_user·u + b)
+    followed by a partial sort. Note that with this rating component, users only differ by
+    their bias and the songs excluded from their recommendations.
+    """
+
+    def __init__(self, model, song_table, index='flat', **index_args):
+        self.model = model.eval()
+        self.song_table = song_table
+        self.embeddings = embed_catalogue(model, song_table)
+        weight = model.RC.weight.detach().numpy()[0]
+        self.w_user, self.w_song = weight[:model.emb_size], weight[model.emb_size:]
+        self.b = model.RC.bias.item()
+        self.index = IVFIndex(self.embeddings, **index_args) if index == 'ivf' \
+            else FlatIndex(self.embeddings)
+
+    def user_features(self, user, playlist, behaviors, lengths):
+        """Computes the user features of a batch of users, as returned by collate_users."""
+        with torch.inference_mode():
+            latent_playlist = self.model.MFC(playlist)
+            return self.model.user_feature(user, latent_playlist, behaviors, lengths).float() \
+                .numpy()
+
+    def recommend(self, user, playlist, behaviors, lengths, k=10, exclude=None):
+        """Returns the (song rows, scores) of the k best songs for each user of the batch."""
+        bias = self.user_features(user, playlist, behaviors, lengths) @ self.w_user + self.b
+        return self.index.search(self.w_song[None], k, bias, exclude)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Recommends the top-K songs to users of the dataset.')
+
+    # ~ data processing
+    add_arguments(parser)
+
+    # ~ recommendation params
+    parser.add_argument('--model', metavar='PATH', type=str, required=True,
+        help='Model file, as saved by run.py --save.')
+    parser.add_argument('--users', metavar='ID', type=str, nargs='*',
+        help='Users to recommend songs to, defaults to every user of the split.')
+    parser.add_argument('--split', choices=('train', 'test'), default='test',
+        help='Set from which the users and their playlists are taken.')
+    parser.add_argument('--k', metavar='NB', type=int, default=10,
+        help='Number of songs to recommend per user.')
+    parser.add_argument('--long-term-len', metavar='NB', type=int, default=20,
+        help='Length of a long-term user playlist.')
+    parser.add_argument('--index', choices=('flat', 'ivf'), default='flat',
+        help='Exact search or approximate search on clusters of songs.')
+    parser.add_argument('--n-lists', metavar='NB', type=int, default=1024,
+        help='Number of song clusters of the ivf index.')
+    parser.add_argument('--n-probe', metavar='NB', type=int, default=16,
+        help='Number of clusters scanned per user by the ivf index.')
+    parser.add_argument('--batch-size', metavar='NB', type=int, default=256,
+        help='Number of users scored at once.')
+
+    args = parser.parse_args()
+
+    data = load_data(args)
+    model = DTNMR.load(args.model, **data.sizes())
+    index_args = dict(n_lists=args.n_lists, n_probe=args.n_probe) if args.index == 'ivf' else {}
+    recommender = Recommender(model, data.song_table, args.index, **index_args)
+
+    points, playlist = (data.train_points, data.train_playlist) if args.split == 'train' \
+        else (data.test_points, data.test_playlist)
+    dataset = MRSDataset(points, playlist, data.users, data.song_table, data.encode_user,
+        data.encode_behavior, subset_size=1, Lt_playlist_len=args.long_term_len,
+        sparse=model.sparse)
+
+    # Every song of the user's playlist is known, the ones already played are not recommended.
+    users = args.users or list(playlist)
+    for start in range(0, len(users), args.batch_size):
+        rows = [playlist.index[user_id] for user_id in users[start:start + args.batch_size]]
+        lengths = np.diff(playlist.offsets)[rows]
+        batch = collate_users([dataset.encode(row, length) for row, length in zip(rows, lengths)])
+        exclude = [np.asarray(playlist.rows(playlist.users[row])[0]) for row in rows]
+        songs, scores = recommender.recommend(*batch, k=args.k, exclude=exclude)
+        for row, best in zip(rows, songs):
+            print('{}\t{}'.format(playlist.users[row], ' '.join(data.song_table.ids[best])))
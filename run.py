@@ -2,35 +2,141 @@
 # coding: utf-8
 
 import os, pdb
+from functools import partial
 from argparse import ArgumentParser
 
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+import torch.multiprocessing as mp
 
-from utils.misc import get
-from utils.dumper import save, load
-from processing import process_training, process_songs, process_users, construct_datapoints
-from encoding import UserEncoder, SongEncoder, BehaviorEncoder
-from dataset import MRSDataset
+from pipeline import add_arguments, load_data
+from dataset import MRSDataset, BucketBatchSampler, DedupCollate, collate, seed_worker
 from model import DTNMR, DTNMRWrapper
+from evaluate import Evaluator
+from utils.sampling import NegativeSampler
+from utils.profiling import StepProfiler, TimedCollate
+from utils import distributed, fastmath
+from utils.fastmath import PRECISIONS
+
+def build(args, data, rank=0, world_size=1, checkpoint=None, profiler=None,
+    signatures=(None, None)):
+    """
+    Builds the datasets, data loaders, model, optimizer and evaluator of a training run given
+    the training arguments (see add_training_arguments), returns the DTNMRWrapper. The model
+    is restored from checkpoint if given. signatures are the encoding.PlaylistSignatures of the
+    training and test playlists, computed by the datasets if not given.
+    """
+    # Ranks share the batches (batch_seed) but draw different negatives (seed + rank). The
+    # batches are always seeded so that an epoch can be resumed from its middle.
+    seed = None if args.seed is None else args.seed + rank
+    if seed is not None:
+        torch.manual_seed(seed) # DataLoader workers derive their seed from it
+    batch_seed = args.seed if args.seed is not None else \
+        distributed.broadcast(int(np.random.randint(2**31)))
+    shard = dict(rank=rank, world_size=world_size, seed=batch_seed)
+
+    sampler = NegativeSampler(len(data.song_table), mode=args.sampler,
+        popularity=data.songs.columns['popularity'], exclude_history=args.exclude_history,
+        seed=seed)
+    train_set = MRSDataset(data.train_points, data.train_playlist, data.users, data.song_table,
+        data.encode_user, data.encode_behavior, subset_size=args.subset_size,
+        Lt_playlist_len=args.long_term_len, sparse=args.sparse, sampler=sampler, dedup=args.dedup,
+        signatures=signatures[0])
+    dtype = PRECISIONS[args.precision] # batches are collated in the compute dtype
+    collate_fn = DedupCollate(data.song_table, args.sparse, dtype) if args.dedup \
+        else partial(collate, dtype=dtype)
+    loader_args = dict(collate_fn=collate_fn, num_workers=args.num_workers,
+        pin_memory=args.pin_memory, worker_init_fn=seed_worker)
+    if args.num_workers:
+        loader_args.update(prefetch_factor=args.prefetch_factor, persistent_workers=True)
+    train_dl = DataLoader(train_set, **dict(loader_args,
+        collate_fn=TimedCollate(collate_fn) if profiler else collate_fn),
+        batch_sampler=BucketBatchSampler(train_set.lengths(), args.batch_size, **shard))
+
+    valid_set = MRSDataset(data.test_points, data.test_playlist, data.users, data.song_table,
+        data.encode_user, data.encode_behavior, subset_size=args.subset_size,
+        Lt_playlist_len=args.long_term_len, sparse=args.sparse,
+        sampler=NegativeSampler(len(data.song_table), seed=seed), dedup=args.dedup,
+        signatures=signatures[1])
+    valid_dl = DataLoader(valid_set, **loader_args,
+        batch_sampler=BucketBatchSampler(valid_set.lengths(), args.batch_size, **shard,
+            even=False))
+
+    if checkpoint:
+        model = DTNMR(**checkpoint['config'])
+    else:
+        model = DTNMR(**data.sizes(), st_playlist_len=args.short_term_len,
+            emb_size=args.emb_size, sparse=args.sparse)
+    if args.compile:
+        fastmath.compile(model)
+    if world_size > 1:
+        model = DistributedDataParallel(model) # copies the weights of rank 0 to every rank
+    optimizer = torch.optim.SGD(model.parameters(), lr=args.lr)
+    evaluator = Evaluator(valid_set, k=args.k, negatives=args.eval_negatives or None,
+        seed=args.eval_seed)
+    system = DTNMRWrapper(model, train_dl, valid_dl, optimizer, evaluator, profiler, dtype)
+    if checkpoint:
+        system.restore(checkpoint)
+
+    return system
+
+
+def main(rank, args):
+    """
+    Trains a model, as one of the ranks of data-parallel training when rank is given or when
+    launched by torchrun. Rank 0 reports the metrics and saves the model.
+    """
+    rank, world_size = distributed.init(rank, args.workers if rank is not None else None,
+        threads=args.threads)
+    main_rank = rank == 0
+
+    # Rank 0 (re)builds the caches if needed, the other ranks wait to read them.
+    if not main_rank:
+        distributed.barrier()
+    data = load_data(args)
+    if main_rank:
+        distributed.barrier()
+
+    song_mhe_size = len(data.encode_song)
+    user_mhe_size = len(data.encode_user)
+    behavior_mhe_size = len(data.encode_behavior)
+
+    # A checkpoint is only valid with the encodings of the cache it was trained on.
+    checkpoint = None
+    if args.resume:
+        checkpoint = torch.load(args.resume)
+        DTNMR.check(checkpoint['config'], **data.sizes())
+        args.sparse = checkpoint['config']['sparse']
+        if args.num_workers and main_rank:
+            print('warning: the DataLoader workers reseed their negative sampler, resuming with '
+                '--num-workers draws other negatives than an uninterrupted run')
+
+    if main_rank:
+        print('song_mhe_size= {},\nuser_mhe_size= {},\nbehavior_mhe_size= {}' \
+            .format(song_mhe_size, user_mhe_size, behavior_mhe_size))
+        print('train set: [{} users, {} interactions] - test set: [{} users, {} interactions]' \
+            .format(len(data.train_playlist), len(data.train_points), len(data.test_playlist),
+                len(data.test_points)))
 
-if __name__ == '__main__':
-    parser = ArgumentParser()
-
-    # ~ data processing
-    parser.add_argument('--reload', action='store_true', default=False,
-        help='Add flag to perform initial data extraction and pre-processing from .csv files.')
-    parser.add_argument('--top', metavar='RATIO', type=float, default=0.001,
-        help='Will only keep the songs among the RATIO in popularity.')
-    parser.add_argument('--min-playlist-len', metavar='NB', type=int, default=20,
-        help='Minimum admissible playlist size, all users with a lower number will be left out.')
-    parser.add_argument('--max-playlist-len', metavar='NB', type=int, default=200,
-        help='Maximum admissible playlist size, all users with a higher number will be left out.')
-    parser.add_argument('--db', metavar='PATH', type=str, default='../db',
-        help='Directory where the WSDM-KKBOX csv files are located.')
-    parser.add_argument('--cache', metavar='PATH', type=str, default='data',
-        help='Directory where the processed data is or will be saved.')
-
+    ## Training
+    profiler = None
+    if args.profile_log or args.profile_steps:
+        profiler = StepProfiler(args.profile_log, args.trace_dir, args.profile_start,
+            args.profile_steps, rank=rank, world_size=world_size)
+    system = build(args, data, rank, world_size, checkpoint, profiler)
+    system.train(args.epochs, checkpoint_dir=args.checkpoint_dir, every=args.checkpoint_every,
+        metric=args.checkpoint_metric)
+    if profiler:
+        profiler.close()
+    if args.save and main_rank:
+        system.module.save(args.save)
+    distributed.cleanup()
+
+
+def add_training_arguments(parser):
+    """Adds the arguments of a training run, as used by `build`, to an ArgumentParser."""
     # ~ training params
     parser.add_argument('--subset-size', metavar='NB', type=int, default=5,
         help='Number of items in the negative sampling.')
@@ -38,75 +144,97 @@ if __name__ == '__main__':
         help='Length of a short-term user playlist.')
     parser.add_argument('--long-term-len', metavar='NB', type=int, default=20,
         help='Length of a long-term user playlist.')
-    # bs, epochs, lr
-
-    args = parser.parse_args()
-
-    assert(os.path.isdir(args.db))
-
-    ## Initial load, processing and saving
-    if args.reload or not os.path.isdir('data'):
-        os.makedirs('data', exist_ok=True)
-
-        # Training data
-        train_headers, train = get(os.sep.join((args.db, 'train.csv')))
-        popularity, most_popular = process_training(train)
-
-        # Songs
-        song_headers, songs_csv = get(os.sep.join((args.db, 'songs.csv')))
-        songs, *song_sets = process_songs(songs_csv, popularity, most_popular, top=args.top)
-        save('data/songs.p', songs, *song_sets)
+    parser.add_argument('--sparse', action='store_true', default=False,
+        help='Add flag to feed users and songs as sparse index lists instead of multi-hot vectors.')
+    parser.add_argument('--dedup', action='store_true', default=False,
+        help='Add flag to embed each distinct song of a batch once, however often it occurs.')
+    parser.add_argument('--batch-size', metavar='NB', type=int, default=16,
+        help='Number of points per batch.')
+    parser.add_argument('--epochs', metavar='NB', type=int, default=1,
+        help='Number of training epochs.')
+    parser.add_argument('--lr', metavar='RATE', type=float, default=0.1,
+        help='Learning rate of the SGD optimizer.')
+    parser.add_argument('--emb-size', metavar='NB', type=int, default=32,
+        help='Size of the user and song embeddings.')
+
+    # ~ fast math
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+        help='Compute dtype of the forward and backward passes, bf16 keeps float32 weights.')
+    parser.add_argument('--compile', action='store_true', default=False,
+        help='Add flag to compile the model with torch.compile, when available.')
+
+    # ~ negative sampling
+    parser.add_argument('--sampler', type=str, default='uniform',
+        choices=('uniform', 'popularity', 'in-batch'),
+        help='How negatives are drawn: uniformly, proportionally to the number of plays or '
+            'from the labels of the other points of the batch.')
+    parser.add_argument('--exclude-history', action='store_true', default=False,
+        help='Add flag to never draw songs of the known playlist as negatives.')
+    parser.add_argument('--seed', metavar='NB', type=int, default=None,
+        help='Seed of the negative sampling and batch order, for reproducible runs.')
+
+    # ~ evaluation
+    parser.add_argument('--k', metavar='NB', type=int, default=10,
+        help='Cutoff of the HR@K and NDCG@K validation metrics.')
+    parser.add_argument('--eval-negatives', metavar='NB', type=int, default=100,
+        help='Number of fixed negatives the label is ranked against, 0 for the whole catalogue.')
+    parser.add_argument('--eval-seed', metavar='NB', type=int, default=0,
+        help='Seed of the fixed validation negatives.')
+
+    # ~ data loading
+    parser.add_argument('--num-workers', metavar='NB', type=int, default=0,
+        help='Number of DataLoader worker processes, 0 loads the data in the main process.')
+    parser.add_argument('--prefetch-factor', metavar='NB', type=int, default=2,
+        help='Number of batches loaded in advance by each worker.')
+    parser.add_argument('--pin-memory', action='store_true', default=False,
+        help='Add flag to copy batches into pinned memory (when training on GPU).')
 
-        # Users
-        user_headers, users_csv = get(os.sep.join((args.db, 'members.csv')))
-        users, *user_sets = process_users(users_csv)
-        save('data/users.p', users, *user_sets)
 
-        # Actual data train/test data points
-        test_headers, test = get(os.sep.join((args.db, 'test.csv')))
-        save('data/training.p', *construct_datapoints(train, users, songs,
-            min_len=args.min_playlist_len, max_len=args.max_playlist_len))
-        save('data/testing.p', *construct_datapoints(test, users, songs,
-            min_len=args.min_playlist_len, max_len=args.max_playlist_len))
-
-
-    ## Loading processed data and encoding
-    # Songs
-    songs, *song_sets = load(os.sep.join((args.cache, 'songs.p')))
-    encode_song = SongEncoder(*song_sets)
-    song_mhe_size = len(encode_song)
-
-    # Users
-    users, *user_sets = load(os.sep.join((args.cache, 'users.p')))
-    encode_user = UserEncoder(*user_sets, encode_song)
-    user_mhe_size = len(encode_user)
-
-    # Playlists
-    train_points, train_playlist, behaviors = load(os.sep.join((args.cache, 'training.p')))
-    test_points, test_playlist, _ = load(os.sep.join((args.cache, 'testing.p')))
-
-    # Behaviors
-    encode_behavior = BehaviorEncoder(behaviors)
-    behavior_mhe_size = len(encode_behavior)
-
-    print('song_mhe_size= {},\nuser_mhe_size= {},\nbehavior_mhe_size= {}' \
-        .format(song_mhe_size, user_mhe_size, behavior_mhe_size))
-    print('train set: [{} users, {} interactions] - test set: [{} users, {} interactions]' \
-        .format(len(train_playlist), len(train_points), len(test_playlist), len(test_points)))
-
-    ## Training
-    train_set = MRSDataset(train_points, train_playlist, users, songs, encode_user, encode_song,
-        encode_behavior, subset_size=args.subset_size, Lt_playlist_len=args.long_term_len)
-    train_dl = DataLoader(train_set, batch_size=16, shuffle=True)
+if __name__ == '__main__':
+    parser = ArgumentParser()
 
-    valid_set = MRSDataset(test_points, test_playlist, users, songs, encode_user, encode_song,
-        encode_behavior, subset_size=args.subset_size, Lt_playlist_len=args.long_term_len)
-    valid_dl = DataLoader(valid_set, batch_size=16, shuffle=True)
+    # ~ data processing
+    add_arguments(parser)
+
+    # ~ training, negative sampling, evaluation and data loading
+    add_training_arguments(parser)
+
+    # ~ saving and checkpointing
+    parser.add_argument('--save', metavar='PATH', type=str, default=None,
+        help='File where the model is saved after training, see recommend.py.')
+    parser.add_argument('--checkpoint-dir', metavar='PATH', type=str, default=None,
+        help='Directory where last.pt is saved after each epoch and best.pt on improvement.')
+    parser.add_argument('--checkpoint-every', metavar='NB', type=int, default=None,
+        help='Number of steps between checkpoints of last.pt, in addition to the epoch ends.')
+    parser.add_argument('--checkpoint-metric', metavar='NAME', type=str, default='loss',
+        help='Validation metric defining best.pt (e.g. loss, MRR, NDCG@10), the loss is minimized.')
+    parser.add_argument('--resume', metavar='PATH', type=str, default=None,
+        help='Checkpoint to resume the training from, possibly in the middle of an epoch.')
+
+    # ~ profiling
+    parser.add_argument('--profile-log', metavar='PATH', type=str, default=None,
+        help='File where the timings of each training step are written, .csv or .jsonl.')
+    parser.add_argument('--profile-start', metavar='NB', type=int, default=10,
+        help='First step recorded by torch.profiler, steps before are left out as warm-up.')
+    parser.add_argument('--profile-steps', metavar='NB', type=int, default=0,
+        help='Number of steps recorded by torch.profiler and exported as a Chrome trace.')
+    parser.add_argument('--trace-dir', metavar='PATH', type=str, default='traces',
+        help='Directory where the Chrome traces are written.')
+
+    # ~ distributed training
+    parser.add_argument('--workers', metavar='NB', type=int, default=1,
+        help='Number of data-parallel training processes, ignored when launched by torchrun.')
+    parser.add_argument('--threads', metavar='NB', type=int, default=None,
+        help='Number of intra-op threads per process, the cores are split between them by default.')
 
+    args = parser.parse_args()
 
-    model = DTNMR(user_mhe_size, song_mhe_size, behavior_mhe_size,
-        st_playlist_len=args.short_term_len, emb_size=32)
-    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
-    system = DTNMRWrapper(model, train_dl, valid_dl, optimizer)
+    if distributed.launched() or args.workers == 1:
+        main(None, args)
+    else:
+        load_data(args) # builds the caches once, before spawning the ranks
+        args.reload = False # the ranks only load them
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', str(distributed.free_port()))
+        mp.spawn(main, args=(args,), nprocs=args.workers)
 
-    system.train(epochs=1)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import asyncio, json, time
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pipeline import add_arguments, load_data
+from dataset import collate_users
+from model import DTNMR
+from recommend import Recommender
+from streaming import UserStateCache
+from utils.http import read_message, write_response
+
+"""
+Online scoring service: a local HTTP server answering POST /score requests with the scores of
+candidate songs, or the top-K songs of the catalogue, for a user and its recent history.
+Concurrent requests are coalesced into micro-batches (see MicroBatcher), each batch takes a
+single DTNMR forward pass on a thread pool. GET /metrics reports the latency percentiles and
+throughput, see loadgen.py to put the server under load.
+"""
+
+class Scorer:
+    """
+    Scores a micro-batch of requests at once. A request is a dict with the keys
+        user: id of the user, its metadata is read from the cache (none for unknown users)
+        history: ids of the songs the user listened to, in time order, unknown songs are
+            ignored and at least one must be known
+        behaviors: optional, the source_system_tab of each history song
+        candidates: optional, ids of the songs to score, the whole catalogue by default
+        k: optional, number of songs returned (10 by default for the catalogue, all the
+            candidates otherwise), best first
+        exclude_history: optional, whether the history songs are left out of the catalogue
+            recommendations (true by default)
+    The response holds the `songs` ids and their `scores`.
+
+    Given a streaming.UserStateCache, requests with a `listened` key are stateful instead: the
+    songs listened to since the last request of the user (possibly none) and optionally their
+    `listened_behaviors` update the user's cached state, history and behaviors are only read
+    when the user isn't in the cache. Events of a user must not be sent concurrently.
+
+    As in recommend.Recommender, Score(u, s) = w_user·user_feature(u) + w_song·embedding(s) + b:
+    the song embeddings are computed once, only the user features go through the model. Over
+    the whole catalogue users only differ by their bias, so the songs are ranked once and the
+    top-K of a user is the head of that ranking minus the excluded songs.
+    """
+
+    def __init__(self, model, data, Lt_playlist_len=20, states=None):
+        self.data = data
+        self.states = states
+        self.sparse = model.sparse
+        self.Lt_playlist_len = Lt_playlist_len
+        self.recommender = Recommender(model, data.song_table)
+        self.song_scores = self.recommender.embeddings @ self.recommender.w_song
+        self.ranking = np.argsort(-self.song_scores, kind='stable')
+        self.behaviors = {} # encoding of each behavior value seen so far
+
+    def encode_behavior(self, behavior):
+        if behavior not in self.behaviors:
+            self.behaviors[behavior] = self.data.encode_behavior([behavior])
+        return self.behaviors[behavior]
+
+    def encode(self, request):
+        """Returns the (user, playlist, behaviors) encodings of a request, see MRSDataset.encode."""
+        table = self.data.song_table
+        history = list(request.get('history', ()))
+        behaviors = request.get('behaviors') or ['null'] * len(history)
+        if len(behaviors) != len(history):
+            raise ValueError('history and behaviors have different lengths')
+        known = [(table.index[s], b) for s, b in zip(history, behaviors) if s in table.index]
+        if not known:
+            raise ValueError('no song of the history is in the catalogue')
+
+        window = known[-self.Lt_playlist_len:]
+        gather = table.sparse if self.sparse else table.dense
+        playlist = [gather(row) for row, _ in window]
+        behaviors = np.stack([self.encode_behavior(b) for _, b in window])
+
+        encode_user = self.data.encode_user
+        signature = encode_user.sparse_signature([table.sparse(row) for row, _ in known])
+        metadata = self.data.users[request['user']] if request['user'] in self.data.users \
+            else ([], [], [])
+        user = encode_user.with_signature(*metadata, signature, sparse=self.sparse)
+        return user, playlist, behaviors
+
+    def __call__(self, requests):
+        """
+        Returns the response of each request, or the ValueError raised by an invalid one so
+        that it doesn't fail the rest of the batch.
+        """
+        table = self.data.song_table
+        responses, encoded = [None] * len(requests), []
+        for i, request in enumerate(requests):
+            try:
+                if not isinstance(request, dict) or 'user' not in request:
+                    raise ValueError('expected an object with at least user and history')
+                k, candidates = request.get('k'), request.get('candidates')
+                if k is not None and (type(k) is not int or k < 0):
+                    raise ValueError('k must be a non-negative integer')
+                if candidates is not None and (not isinstance(candidates, list)
+                    or not all(isinstance(s, str) for s in candidates)):
+                    raise ValueError('candidates must be a list of song ids')
+                if self.states is not None and 'listened' in request:
+                    state, feature = self.states.observe(request['user'], request['listened'],
+                        request.get('listened_behaviors'), request.get('history'),
+                        request.get('behaviors'))
+                    bias = feature.numpy() @ self.recommender.w_user + self.recommender.b
+                    responses[i] = self.rank(request, bias, state.played)
+                else:
+                    encoded.append((i, self.encode(request)))
+            except (ValueError, TypeError, KeyError) as e:
+                responses[i] = ValueError(str(e))
+        if not encoded:
+            return responses
+
+        valid, items = zip(*encoded)
+        features = self.recommender.user_features(*collate_users(items))
+        bias = features @ self.recommender.w_user + self.recommender.b
+        for i, b in zip(valid, bias):
+            try:
+                history = requests[i].get('history', ())
+                responses[i] = self.rank(requests[i], b,
+                    {table.index[s] for s in history if s in table.index})
+            except (ValueError, TypeError, KeyError) as e:
+                responses[i] = ValueError(str(e))
+        return responses
+
+    def rank(self, request, bias, played):
+        """
+        Returns the best songs of the request and their scores, given the user's bias and the
+        song rows it played.
+        """
+        table = self.data.song_table
+        if request.get('candidates') is not None:
+            rows = np.array([table.index[s] for s in request['candidates'] if s in table.index],
+                dtype=np.int64)
+            k = request.get('k', len(rows))
+            best = rows[np.argsort(-self.song_scores[rows], kind='stable')[:k]]
+        else:
+            k = request.get('k', 10)
+            excluded = played if request.get('exclude_history', True) else set()
+            head = self.ranking[:k + len(excluded)]
+            best = head[[row not in excluded for row in head.tolist()]][:k]
+        return {'songs': table.ids[best].tolist(),
+            'scores': (self.song_scores[best] + bias).tolist()}
+
+
+class Stats:
+    """
+    Request counters and the latencies (seconds) of the last `window` requests, along with the
+    counters of the user state cache if any.
+    """
+
+    def __init__(self, window=10000, states=None):
+        self.latencies = deque(maxlen=window)
+        self.states = states
+        self.start = time.perf_counter()
+        self.requests, self.errors, self.batches = 0, 0, 0
+
+    def record(self, latency, error=False):
+        self.requests += 1
+        self.errors += error
+        self.latencies.append(latency)
+
+    def report(self):
+        """Returns the counters, the throughput since start-up and the latency percentiles."""
+        latencies = np.array(self.latencies) * 1000
+        uptime = time.perf_counter() - self.start
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / max(self.batches, 1),
+            'throughput': self.requests / uptime,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'uptime_s': uptime,
+            **({'states': self.states.report()} if self.states is not None else {}),
+        }
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into micro-batches. The first waiting request opens a batch,
+    which is run as soon as it holds max_batch requests or max_delay seconds after it opened,
+    whichever comes first: max_delay is the latency budget traded for larger batches. Batches
+    run on a pool of `threads` threads, the event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, score, max_batch=64, max_delay=0.002, threads=1, stats=None):
+        """
+        Parameters
+        ---
+        score: function(list of requests) -> list of responses
+            Scores a batch, e.g. a Scorer. A response which is an Exception is raised to the
+            request's caller.
+        """
+        self.score = score
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pool = ThreadPoolExecutor(threads)
+        self.slots = asyncio.Semaphore(threads)
+        self.queue = asyncio.Queue()
+        self.stats = stats or Stats()
+
+    async def submit(self, request):
+        """Queues the request and returns its response once its batch has been scored."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((request, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire() # batches keep filling up while every thread is busy
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+            self.stats.batches += 1
+            loop.create_task(self.execute(batch))
+
+    async def execute(self, batch):
+        requests, futures = zip(*batch)
+        try:
+            responses = await asyncio.get_running_loop().run_in_executor(self.pool, self.score,
+                list(requests))
+        except Exception as e:
+            responses = [e] * len(requests)
+        finally:
+            self.slots.release()
+        for future, response in zip(futures, responses):
+            if future.cancelled():
+                continue
+            if isinstance(response, Exception):
+                future.set_exception(response)
+            else:
+                future.set_result(response)
+
+
+class Server:
+    """HTTP front-end: POST /score, GET /metrics and GET /health, with keep-alive."""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.stats = batcher.stats
+
+    async def handle(self, reader, writer):
+        try:
+            while (message := await read_message(reader)) is not None:
+                start_line, headers, body = message
+                status, response = await self.route(*start_line.split(' ')[:2], body)
+                write_response(writer, status, response)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.stats.report()
+        if method != 'POST' or path != '/score':
+            return 404, {'error': 'unknown endpoint {} {}'.format(method, path)}
+
+        start = time.perf_counter()
+        try:
+            status, response = 200, await self.batcher.submit(json.loads(body))
+        except ValueError as e: # json.JSONDecodeError is a ValueError too
+            status, response = 400, {'error': str(e)}
+        except Exception as e:
+            status, response = 500, {'error': repr(e)}
+        self.stats.record(time.perf_counter() - start, error=status != 200)
+        return status, response
+
+
+async def serve(batcher, host, port):
+    server = await asyncio.start_server(Server(batcher).handle, host, port)
+    print('serving on http://{}:{}'.format(host, port), flush=True)
+    async with server:
+        await asyncio.gather(server.serve_forever(), batcher.run())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serves the recommendations of a model over HTTP.')
+
+    # ~ data processing
+    add_arguments(parser)
+
+    # ~ serving params
+    parser.add_argument('--model', metavar='PATH', type=str, required=True,
+        help='Model file, as saved by run.py --save, or a checkpoint.')
+    parser.add_argument('--host', metavar='HOST', type=str, default='127.0.0.1',
+        help='Address the server listens on.')
+    parser.add_argument('--port', metavar='NB', type=int, default=8080,
+        help='Port the server listens on.')
+    parser.add_argument('--long-term-len', metavar='NB', type=int, default=20,
+        help='Length of a long-term user playlist.')
+    parser.add_argument('--max-batch', metavar='NB', type=int, default=64,
+        help='Maximum number of requests scored in a single forward pass.')
+    parser.add_argument('--max-delay', metavar='MS', type=float, default=2,
+        help='Latency budget: time a request may wait for others to join its batch.')
+    parser.add_argument('--threads', metavar='NB', type=int, default=1,
+        help='Number of batches scored concurrently.')
+    parser.add_argument('--state-capacity', metavar='NB', type=int, default=100000,
+        help='Number of users whose state is kept for stateful requests, 0 to disable them.')
+
+    args = parser.parse_args()
+
+    data = load_data(args)
+    model = DTNMR.load(args.model, **data.sizes())
+    states = UserStateCache(model.eval(), data, args.long_term_len, args.state_capacity) \
+        if args.state_capacity else None
+    scorer = Scorer(model, data, args.long_term_len, states)
+    batcher = MicroBatcher(scorer, args.max_batch, args.max_delay / 1000, args.threads,
+        Stats(states=states))
+    try:
+        asyncio.run(serve(batcher, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,215 @@
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+
+from dataset import collate_songs
+from utils.nn import Bags, SparseLinear
+
+"""
+Incremental user features for streaming listen events. The user feature of DTNMR is
+    USFC(user_encoding) + UDFC(long-term window) + UDFC(short-term window)
+and recomputing it from the whole history at every event costs an MFC pass over the window,
+two LSTM passes and the first USFC layer over the full encoding. UserStateCache keeps, per
+user, what is needed to update it with a single new song instead.
+"""
+
+class UserState:
+    """
+    Streaming state of a user.
+
+    Attributes
+    ---
+    signature: np.ndarray
+        Bitset of the user's playlist signature (see UserEncoder.playlist_signature).
+    static: torch.Tensor
+        Pre-activation of the first USFC layer, i.e. before its ReLU.
+    window: deque of torch.Tensor
+        [MFC embedding, behavior encoding] of the last songs, the long-term window.
+    length: int
+        Number of songs of the history.
+    lstm_state: (h, c) tuple
+        LSTM state over the whole window, as long as it has never slid (length <= window size).
+    played: set of int
+        Song rows of the history, left out of the recommendations.
+    feature: torch.Tensor
+        The user feature, None until computed again after an update.
+    """
+    __slots__ = ('signature', 'static', 'window', 'length', 'lstm_state', 'played', 'feature')
+
+    def __init__(self, signature, static, Lt_playlist_len):
+        self.signature = signature
+        self.static = static
+        self.window = deque(maxlen=Lt_playlist_len)
+        self.length = 0
+        self.lstm_state = None
+        self.played = set()
+        self.feature = None
+
+
+class UserStateCache:
+    """
+    Size-bounded store of UserState, the least recently used users are evicted first. Adding a
+    song to a user's history takes O(1) model work:
+        - USFC: the signature bits the song sets for the first time add their weight columns
+          to the cached first-layer pre-activation, the rest of the MLP is small.
+        - MFC: only the new song is embedded, the window embeddings are cached.
+        - UDFC: while the long-term window grows, the LSTM state is carried over and advanced
+          by one step. Once it slides, the first song leaves the window and the LSTM has to run
+          over the whole (cached) window again, which is the fallback. The short-term window is
+          a suffix of at most short-term-length steps, run again unless it equals the long-term
+          one.
+    The features are the same as DTNMR.user_feature on the full encodings, up to float error.
+    The cache is thread-safe, updates of the model states hold a lock.
+
+    Example:
+    ---
+        states = UserStateCache(model, data, Lt_playlist_len=20, capacity=100000)
+        state, feature = states.observe(user_id, [song_id], ['my library'])
+    """
+
+    def __init__(self, model, data, Lt_playlist_len=20, capacity=100000):
+        """
+        Parameters
+        ---
+        model: model.DTNMR
+            The model, in eval mode.
+        data: pipeline.Data
+            Provides the song table, user metadata and encoders.
+        capacity: int
+            Maximum number of users kept.
+        """
+        self.model = model
+        self.data = data
+        self.Lt_playlist_len = Lt_playlist_len
+        self.capacity = capacity
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.behaviors = {}
+        # Column of the first USFC layer of signature bit 0.
+        self.signature_offset = len(data.encode_user) - (len(data.encode_song) - 1)
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __contains__(self, user_id):
+        return user_id in self.states
+
+    def __len__(self):
+        return len(self.states)
+
+    def get(self, user_id):
+        """Returns the user's state, None if unknown or evicted."""
+        state = self.states.get(user_id)
+        if state is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.states.move_to_end(user_id)
+        return state
+
+    def put(self, user_id, state):
+        self.states[user_id] = state
+        self.states.move_to_end(user_id)
+        while len(self.states) > self.capacity:
+            self.states.popitem(last=False)
+            self.evictions += 1
+
+    def start(self, user_id, history=(), behaviors=None):
+        """
+        Computes the state of the user from scratch given its history (song ids in time order
+        and their behaviors), e.g. a new user or one that was evicted.
+        """
+        metadata = self.data.users[user_id] if user_id in self.data.users else ([], [], [])
+        encoded = self.data.encode_user.with_signature(*metadata, np.empty(0, np.int64),
+            sparse=self.model.sparse)
+        layer = self.model.USFC.input
+        if isinstance(layer, SparseLinear):
+            static = layer(Bags.from_sparse([encoded], (1,)))[0]
+        else:
+            static = layer(torch.from_numpy(encoded).float()[None])[0]
+        state = UserState(np.zeros(len(self.data.encode_song) - 1, dtype=bool), static,
+            self.Lt_playlist_len)
+        self.extend(state, history, behaviors)
+        return state
+
+    def extend(self, state, songs, behaviors=None):
+        """Adds the songs (ids, in time order) to the history of the state, in place."""
+        table = self.data.song_table
+        behaviors = behaviors or ['null'] * len(songs)
+        known = [(table.index[s], b) for s, b in zip(songs, behaviors) if s in table.index]
+        if not known:
+            return
+        rows = np.array([row for row, _ in known], dtype=np.int64)
+
+        # New signature bits, the linear component (bit 0 of songs) is not part of it.
+        bits = np.unique(table.gather(rows)[0])
+        bits = bits[bits > 0] - 1
+        bits = bits[~state.signature[bits]]
+        if len(bits):
+            state.signature[bits] = True
+            state.static = state.static + self.columns(bits + self.signature_offset)
+
+        # Embeddings of the songs which end up in the window only.
+        window = known[-self.Lt_playlist_len:]
+        embeddings = torch.cat([
+            self.model.MFC(collate_songs(table, rows[-len(window):], self.model.sparse)),
+            torch.from_numpy(np.stack([self.encode_behavior(b) for _, b in window])).float()],
+            dim=1)
+        if state.length + len(known) <= self.Lt_playlist_len:
+            _, state.lstm_state = self.model.UDFC.lstm(embeddings[:, None], state.lstm_state)
+        else:
+            state.lstm_state = None
+        state.window.extend(embeddings)
+        state.length += len(known)
+        state.played.update(rows.tolist())
+        state.feature = None
+
+    def columns(self, indices):
+        """Sum of the columns of the first USFC layer at the given input indices."""
+        layer = self.model.USFC.input
+        if isinstance(layer, SparseLinear):
+            return layer.bag.weight[torch.from_numpy(indices)].sum(0)
+        return layer.weight[:, torch.from_numpy(indices)].sum(1)
+
+    def encode_behavior(self, behavior):
+        if behavior not in self.behaviors:
+            self.behaviors[behavior] = self.data.encode_behavior([behavior])
+        return self.behaviors[behavior]
+
+    def feature(self, state):
+        """Returns the (emb_size,) user feature of the state, see DTNMR.user_feature."""
+        if state.feature is not None:
+            return state.feature
+        if not state.length:
+            raise ValueError('no song of the history is in the catalogue')
+        model, UDFC, st = self.model, self.model.UDFC, self.model.st_playlist_len
+        window = torch.stack(list(state.window))[:, None]
+        if state.lstm_state is not None:
+            Lt_dynamic = UDFC.body(state.lstm_state[0][-1])
+            st_dynamic = Lt_dynamic if len(window) <= st else UDFC(window[-st:])
+        else:
+            # Fallback, the window has slid: both windows in a single LSTM call, as in DTNMR.
+            lengths = torch.tensor([len(window)])
+            st_window, st_lengths = model.suffix(window, lengths, st)
+            Lt_dynamic, st_dynamic = UDFC(torch.cat([window, st_window], dim=1),
+                torch.cat([lengths, st_lengths])).chunk(2)
+        user_static = model.USFC.body(state.static[None])
+        state.feature = (user_static + Lt_dynamic + st_dynamic)[0]
+        return state.feature
+
+    def observe(self, user_id, songs=(), behaviors=None, history=None, history_behaviors=None):
+        """
+        Adds the listened songs to the user's history and returns the (state, user feature).
+        An unknown or evicted user starts from the given history, empty by default.
+        """
+        with self.lock, torch.inference_mode():
+            state = self.get(user_id)
+            if state is None:
+                state = self.start(user_id, history or (), history_behaviors)
+            self.extend(state, songs, behaviors)
+            self.put(user_id, state)
+            return state, self.feature(state)
+
+    def report(self):
+        return {'users': len(self.states), 'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import csv, itertools, json, math, os, time, traceback
+import multiprocessing as mp
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+
+import numpy as np
+import torch
+
+from pipeline import add_arguments, load_data
+from encoding import PlaylistSignatures
+from run import add_training_arguments, build
+
+"""
+Hyperparameter sweep: trains one model per point of a grid, or per random draw, of the
+training arguments of run.py, several trials at a time. The data is loaded, encoded and
+indexed once by the main process: the trial processes are forked from it and share it
+(copy-on-write, the caches and song table being memory-mapped anyway). Each trial runs on
+its own threads, trials lagging behind the others are stopped early (see MedianStopping),
+and a table of the results is written along with the log of every trial.
+
+The sweep is described by a JSON file, e.g.
+    {
+        "method": "random",
+        "trials": 20,
+        "parameters": {
+            "lr": {"min": 0.01, "max": 0.3, "log": true},
+            "emb_size": [16, 32, 64],
+            "subset_size": {"min": 3, "max": 20, "int": true},
+            "long_term_len": [10, 20, 40]
+        }
+    }
+With "method": "grid", every parameter is a list of values and every combination is tried.
+Parameters are the training arguments of run.py (subset_size, short_term_len, lr, ...), the
+others are taken from the command line.
+"""
+
+def trials(spec, names, seed=0):
+    """
+    Returns the list of the parameters of each trial of the spec, see the module docstring.
+    names are the accepted parameter names.
+    """
+    parameters = spec.get('parameters', {})
+    unknown = sorted(set(parameters) - set(names))
+    if unknown:
+        raise ValueError('unknown parameters {}, expected among {}'.format(', '.join(unknown),
+            ', '.join(sorted(names))))
+    method = spec.get('method', 'grid')
+    if method == 'grid':
+        if any(not isinstance(values, list) for values in parameters.values()):
+            raise ValueError('grid parameters must be lists of values')
+        return [dict(zip(parameters, values))
+            for values in itertools.product(*parameters.values())]
+    if method != 'random':
+        raise ValueError('unknown method {}, expected grid or random'.format(method))
+
+    rng = np.random.default_rng(seed)
+    def draw(values):
+        if isinstance(values, list):
+            return values[int(rng.integers(len(values)))]
+        low, high = values['min'], values['max']
+        if values.get('log'):
+            value = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            value = rng.uniform(low, high)
+        return int(round(value)) if values.get('int') else float(value)
+    return [{name: draw(values) for name, values in parameters.items()}
+        for _ in range(spec.get('trials', 10))]
+
+
+class MedianStopping:
+    """
+    Median stopping rule: after `grace` epochs, a trial is stopped when its validation metric
+    is worse than the median of the metric of the other trials at the same epoch, provided at
+    least `min_trials` of them got there. The reports are shared by the trial processes
+    through a multiprocessing.Manager list.
+    """
+
+    def __init__(self, reports, metric='MRR', grace=1, min_trials=3):
+        self.reports = reports
+        self.metric = metric
+        self.sign = -1 if metric == 'loss' else 1 # the loss is minimized, the others maximized
+        self.grace = grace
+        self.min_trials = min_trials
+
+    def __call__(self, trial, epoch, metrics):
+        """Reports the metrics of the trial after epoch (0-based), returns whether to stop it."""
+        value = self.sign * metrics[self.metric]
+        others = [v for t, e, v in list(self.reports) if e == epoch and t != trial]
+        self.reports.append((trial, epoch, value))
+        if epoch + 1 < self.grace or len(others) < self.min_trials:
+            return False
+        return value < np.median(others)
+
+
+# State of the trial processes, set before they are forked (see prepare).
+shared = None
+
+def prepare(args):
+    """Loads the data and indexes the playlist signatures, once for every trial."""
+    data = load_data(args)
+    signatures = tuple(PlaylistSignatures(playlist.offsets, playlist.songs, data.song_table)
+        for playlist in (data.train_playlist, data.test_playlist))
+    return data, signatures
+
+def init_worker(args, threads, stopping):
+    global shared
+    torch.set_num_threads(threads)
+    if shared is None: # the process was spawned rather than forked
+        shared = prepare(args)
+    shared = (*shared[:2], stopping)
+
+def run_trial(trial, params, args):
+    """Trains the model of a trial, returns its results. Its output goes to its log file."""
+    data, signatures, stopping = shared
+    args = Namespace(**{**vars(args), **params})
+    args.num_workers = 0 # trials already run in parallel
+    result = {'trial': trial, 'status': 'completed', 'epochs': 0, **params}
+    start = time.perf_counter()
+    with open(os.path.join(args.output, 'trial-{}.log'.format(trial)), 'w') as log, \
+        redirect_stdout(log), redirect_stderr(log):
+        print('trial {}: {}'.format(trial, json.dumps(params)), flush=True)
+        try:
+            system = build(args, data, signatures=signatures)
+            best = None
+            for epoch in range(args.epochs):
+                system.train(epoch + 1)
+                metrics = system.history[-1]
+                value = metrics[stopping.metric]
+                if best is None or stopping.sign * value > stopping.sign * best:
+                    best = value
+                result.update(metrics, epochs=epoch + 1)
+                result['best_' + stopping.metric] = best
+                if epoch + 1 < args.epochs and stopping(trial, epoch, metrics):
+                    result['status'] = 'stopped'
+                    print('stopped early after epoch {}'.format(epoch + 1))
+                    break
+            if args.save:
+                system.module.save(os.path.join(args.output, 'trial-{}.pt'.format(trial)))
+        except Exception as e:
+            traceback.print_exc()
+            result.update(status='failed', error=repr(e))
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def write_results(fp, results, metric):
+    """Writes the results table, best trials first."""
+    sign = -1 if metric == 'loss' else 1
+    key = 'best_' + metric
+    results = sorted(results, key=lambda r: (key not in r, -sign * r.get(key, 0)))
+    fields = list(dict.fromkeys(field for result in results for field in result))
+    with open(fp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(results)
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Runs a hyperparameter sweep of the training arguments.')
+
+    # ~ data processing
+    add_arguments(parser)
+
+    # ~ training, the defaults of the trials
+    add_training_arguments(parser)
+
+    # ~ sweep params
+    parser.add_argument('--spec', metavar='PATH', type=str, required=True,
+        help='JSON file describing the sweep, see sweep.py.')
+    parser.add_argument('--output', metavar='PATH', type=str, default='sweep',
+        help='Directory where results.csv and the log of every trial are written.')
+    parser.add_argument('--parallel', metavar='NB', type=int, default=None,
+        help='Number of trials run at once, by default as many as the cores allow.')
+    parser.add_argument('--trial-threads', metavar='NB', type=int, default=1,
+        help='Number of intra-op threads of each trial.')
+    parser.add_argument('--metric', metavar='NAME', type=str, default='MRR',
+        help='Validation metric the trials are compared on (e.g. loss, MRR, NDCG@10).')
+    parser.add_argument('--grace-epochs', metavar='NB', type=int, default=1,
+        help='Number of epochs a trial runs before it can be stopped early.')
+    parser.add_argument('--min-trials', metavar='NB', type=int, default=3,
+        help='Number of other trials a trial is compared to before it can be stopped early.')
+    parser.add_argument('--save', action='store_true', default=False,
+        help='Add flag to save the model of every trial in the output directory.')
+
+    args = parser.parse_args()
+
+    defaults = ArgumentParser()
+    add_training_arguments(defaults)
+    with open(args.spec) as f:
+        spec = json.load(f)
+    try:
+        points = trials(spec, vars(defaults.parse_args([])), args.seed or 0)
+    except (ValueError, KeyError) as e:
+        parser.error('invalid spec: {}'.format(e))
+    if not points:
+        parser.error('the spec has no trial')
+    if args.seed is None:
+        args.seed = 0 # every trial sees the same batches and negatives
+    parallel = args.parallel or max(1, (os.cpu_count() or 1) // args.trial_threads)
+    os.makedirs(args.output, exist_ok=True)
+
+    shared = prepare(args) # inherited by the forked trial processes
+    method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+    print('{} trials, {} at a time with {} threads each'.format(len(points), parallel,
+        args.trial_threads))
+
+    start, results = time.perf_counter(), []
+    context = mp.get_context(method)
+    with context.Manager() as manager:
+        stopping = MedianStopping(manager.list(), args.metric, args.grace_epochs,
+            args.min_trials)
+        with ProcessPoolExecutor(parallel, mp_context=context, initializer=init_worker,
+            initargs=(args, args.trial_threads, stopping)) as pool:
+            futures = [pool.submit(run_trial, i, params, args) for i, params in enumerate(points)]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print('trial {} {} after {} epochs in {:.0f}s: {}={}'.format(result['trial'],
+                    result['status'], result['epochs'], result['seconds'], args.metric,
+                    result.get('best_' + args.metric)), flush=True)
+                write_results(os.path.join(args.output, 'results.csv'), results, args.metric)
+
+    elapsed = time.perf_counter() - start
+    results = write_results(os.path.join(args.output, 'results.csv'), results, args.metric)
+    print('{} trials in {:.0f}s ({:.1f} trials/hour), results written to {}'.format(
+        len(results), elapsed, len(results) / elapsed * 3600,
+        os.path.join(args.output, 'results.csv')))
+    for result in results[:5]:
+        print(' - '.join('{}={}'.format(name, result.get(name)) for name in
+            ['trial', 'status', 'best_' + args.metric, *points[0]]))
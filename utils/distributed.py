@@ -0,0 +1,85 @@
+import os, socket
+
+import torch
+import torch.distributed as dist
+
+"""
+Helpers for data-parallel training on CPU, one process per rank with the gloo backend. The
+processes are either started by torchrun, which sets the RANK, WORLD_SIZE and MASTER_*
+environment variables, or spawned by run.py --workers N. With a single process every helper
+falls back to a no-op.
+"""
+
+def launched():
+    """Whether the process was started by torchrun."""
+    return 'RANK' in os.environ and 'WORLD_SIZE' in os.environ
+
+def free_port():
+    """Returns a free TCP port of the host, to be used as MASTER_PORT when spawning ranks."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def init(rank=None, world_size=None, threads=None):
+    """
+    Joins the process group and sets the number of intra-op threads of the rank.
+
+    Parameters
+    ---
+    rank, world_size: int
+        Read from the environment (torchrun) by default.
+    threads: int
+        Intra-op threads per rank, by default the cores are split evenly between the ranks so
+        that they don't oversubscribe the machine. Left to torch with a single process.
+    """
+    if rank is None:
+        rank = int(os.environ.get('RANK', 0))
+        world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        dist.init_process_group('gloo', rank=rank, world_size=world_size)
+        threads = threads or max(1, (os.cpu_count() or 1) // world_size)
+    if threads:
+        torch.set_num_threads(threads)
+    return rank, world_size
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+def rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+def world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+def is_main():
+    return rank() == 0
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+def all_reduce(*values):
+    """Sums the float values over all the ranks."""
+    if not dist.is_initialized():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+def broadcast(obj):
+    """Returns the object of rank 0 on every rank."""
+    if not dist.is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects)
+    return objects[0]
+
+def gather(obj):
+    """Returns the list of the objects of every rank."""
+    if not dist.is_initialized():
+        return [obj]
+    objects = [None] * dist.get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
@@ -1,14 +1,37 @@
-import os, pickle
+import os, json, shutil
 
-"""Savagely dumps/loads python objects inside file."""
+import numpy as np
 
-def save(fp, *lists):
-    with open(fp + '.tmp', 'wb') as f:
-        pickle.dump(lists, f)
-    os.replace(fp + '.tmp', fp)
+"""
+Dumps/loads named numpy columns inside a cache directory: one .npy file per column and a
+header.json file recording the format version along with any parameter the content depends
+on. Columns are loaded memory-mapped so that opening the cache costs next to nothing.
+"""
 
-def load(fp):
-    if not os.path.isfile(fp):
+VERSION = 3
+
+class StaleCacheError(Exception):
+    """The cache exists but was built by another format version or with other parameters."""
+
+
+def save(fp, header, **columns):
+    tmp = fp + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, column in columns.items():
+        np.save(os.path.join(tmp, name + '.npy'), column, allow_pickle=False)
+    with open(os.path.join(tmp, 'header.json'), 'w') as f:
+        json.dump({'version': VERSION, **header, 'columns': sorted(columns)}, f, indent=2)
+    shutil.rmtree(fp, ignore_errors=True)
+    os.replace(tmp, fp)
+
+def load(fp, header):
+    """Returns the dict of columns, provided the cache was saved with the same header."""
+    if not os.path.isfile(os.path.join(fp, 'header.json')):
         raise FileNotFoundError(fp)
-    with open(fp, 'rb') as f:
-        return pickle.load(f)
+    with open(os.path.join(fp, 'header.json')) as f:
+        saved = json.load(f)
+    columns = saved.pop('columns')
+    if saved != {'version': VERSION, **header}:
+        raise StaleCacheError('{}: expected {}, found {}'.format(fp, header, saved))
+    return {name: np.load(os.path.join(fp, name + '.npy'), mmap_mode='r') for name in columns}
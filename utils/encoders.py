@@ -1,3 +1,5 @@
+import zlib
+
 import numpy as np
 
 class LinearEncoder:
@@ -17,6 +19,10 @@ class LinearEncoder:
     def __call__(self, x):
         return [round(x[0]/self.max, 4)]
 
+    def sparse(self, x):
+        """Returns the encoding as a pair of lists: the non-zero indices and their values."""
+        return [0], self(x)
+
     def __len__(self):
         return 1
 
@@ -28,14 +34,26 @@ class MHEncoder:
     Example:
     ---
         encode = MHEncoder({'a', 'ab', 'jd', 'ke', 'ca', 'kk', 'p'})
-        encode(['a', 'p', 'jd']) # returns array([1, 0, 1, 0, 0, 0, 1])
+        encode(['a', 'p', 'jd']) # returns array([1, 0, 0, 1, 0, 0, 1])
+
+    Bits are assigned in sorted order of the feature values so the encoding is the same from
+    one run to another (sets of strings iterate in a random order) e.g. for precomputed tables.
     """
 
     def __init__(self, unique):
-        self.mapping = {k: i for i, k in enumerate(unique)}
+        self.mapping = {k: i for i, k in enumerate(sorted(unique))}
 
     def __call__(self, data):
-        return self.mhe([self.mapping[k] for k in data if k in self.mapping])
+        return self.mhe(self.indices(data))
+
+    def indices(self, data):
+        """Returns the bit positions of the known feature values."""
+        return [self.mapping[k] for k in data if k in self.mapping]
+
+    def sparse(self, data):
+        """Returns the encoding as a pair of lists: the non-zero indices and their values."""
+        indices = self.indices(data)
+        return indices, [1.]*len(indices)
 
     def __len__(self):
         return len(self.mapping)
@@ -46,6 +64,59 @@ class MHEncoder:
         return mhe
 
 
+class HashedMHEncoder:
+    """
+    Multi-hot encoder of fixed width: each feature value is hashed into one of `buckets` bits,
+    values hashed into the same bucket share their bit. Unlike MHEncoder, the size of the
+    encoding doesn't depend on the vocabulary and values unknown at initialization are encoded
+    as well.
+
+    Example:
+    ---
+        encode = HashedMHEncoder(8)
+        encode(['a', 'p', 'jd']) # returns a vector of size 8, colliding values are summed
+
+    The hash (crc32) is the same from one run to another. With `signed`, another bit of the hash
+    decides whether a value adds 1 or -1 to its bucket, so that colliding values cancel out
+    rather than pile up. With `min_count`, the values occurring less often than that according
+    to `counts` {value: count} are left out.
+    """
+
+    def __init__(self, buckets, signed=False, counts=None, min_count=None):
+        self.buckets = buckets
+        self.signed = signed
+        self.excluded = {v for v, c in counts.items() if c < min_count} if min_count else set()
+
+    def __call__(self, data):
+        return self.mhe(*self.sparse(data))
+
+    def hash(self, value):
+        """Returns the bucket of the value and its sign."""
+        h = zlib.crc32(str(value).encode('utf8'))
+        return h % self.buckets, -1. if self.signed and h >> 31 else 1.
+
+    def indices(self, data):
+        """Returns the non-zero bit positions."""
+        return self.sparse(data)[0]
+
+    def sparse(self, data):
+        """Returns the encoding as a pair of lists: the non-zero indices and their values."""
+        hashes = [self.hash(v) for v in dict.fromkeys(data) if v not in self.excluded]
+        if not hashes:
+            return [], []
+        indices, inverse = np.unique([i for i, _ in hashes], return_inverse=True)
+        weights = np.bincount(inverse, weights=[sign for _, sign in hashes])
+        return indices[weights != 0].tolist(), weights[weights != 0].tolist()
+
+    def __len__(self):
+        return self.buckets
+
+    def mhe(self, indices, weights):
+        mhe = np.zeros(len(self))
+        mhe[indices] = weights
+        return mhe
+
+
 class Encoder():
     """The encoder wrapper class which allows to combine multiple encoders together into one."""
 
@@ -59,6 +130,21 @@ class Encoder():
             than number of encoders: {}, got {}'''.format(len(self.encoders), len(params))
         return np.concatenate([encoder(param) for encoder, param in zip(self.encoders, params)])
 
+    def sparse(self, *params):
+        """
+        Encodes the list of features values into the (indices, weights) pair of arrays of the
+        non-zero bits. Equivalent to the dense encoding `np.zeros(len(self))[indices] = weights`.
+        """
+        assert len(params) == len(self.encoders), \
+            'Call must have {} parameters, got {}'.format(len(self.encoders), len(params))
+        indices, weights, offset = [], [], 0
+        for encoder, param in zip(self.encoders, params):
+            i, w = encoder.sparse(param)
+            indices += [offset + x for x in i]
+            weights += w
+            offset += len(encoder)
+        return np.array(indices, dtype=np.int64), np.array(weights, dtype=np.float32)
+
     def __len__(self):
         """Returns the number of bits used to encode the data."""
         return sum(map(len, self.encoders))
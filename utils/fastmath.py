@@ -0,0 +1,33 @@
+import warnings
+from contextlib import nullcontext
+
+import torch
+
+"""
+Reduced precision and compilation on CPU. Under autocast, matrix products (Linear, LSTM) run
+in bfloat16, which recent Xeons compute natively (AVX512-BF16, AMX), while the weights, their
+gradients and the optimizer stay in float32: the model is trained and saved as usual. The
+batches are collated directly in the compute dtype (see dataset.collate), so that the wide
+multi-hot encodings aren't converted at every step.
+"""
+
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16}
+
+def autocast(dtype=torch.float32):
+    """Context running the model in dtype with float32 weights, a no-op for float32."""
+    if dtype == torch.float32:
+        return nullcontext()
+    return torch.autocast('cpu', dtype=dtype)
+
+def compile(model):
+    """
+    Compiles the model in place with torch.compile, its state dict keeping the same keys.
+    Returns whether the model is compiled: torch.compile may be unavailable, and parts of the
+    model which fail to compile (e.g. without a C++ compiler) run eagerly instead of failing.
+    """
+    if not hasattr(torch, 'compile') or not hasattr(model, 'compile'):
+        warnings.warn('torch.compile is unavailable, the model runs eagerly')
+        return False
+    torch._dynamo.config.suppress_errors = True # falls back to eager on compilation errors
+    model.compile(dynamic=True) # batch size and playlist length vary from batch to batch
+    return True
@@ -0,0 +1,33 @@
+import json
+
+"""
+Minimal HTTP/1.1 over asyncio streams, enough for a JSON API and its load generator without
+any web framework: messages carry a Content-Length body and connections are kept alive.
+"""
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+async def read_message(reader):
+    """
+    Reads a request or a response from the stream, returns its (start line, headers, body) or
+    None if the connection was closed. Header names are lower-cased.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    headers = {}
+    while (header := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        name, _, value = header.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return line.decode('latin-1').strip(), headers, body
+
+def write_message(writer, start_line, obj=None, headers={}):
+    """Writes a message with obj as JSON body, e.g. start_line='POST /score HTTP/1.1'."""
+    body = b'' if obj is None else json.dumps(obj).encode('utf8')
+    headers = {'Content-Type': 'application/json', 'Content-Length': len(body), **headers}
+    writer.write(''.join([start_line + '\r\n'] + ['{}: {}\r\n'.format(*header)
+        for header in headers.items()] + ['\r\n']).encode('latin-1') + body)
+
+def write_response(writer, status, obj):
+    write_message(writer, 'HTTP/1.1 {} {}'.format(status, REASONS[status]), obj)
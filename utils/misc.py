@@ -1,10 +1,13 @@
-import csv
+import os, csv
 from collections import Counter
+from itertools import islice
+from operator import itemgetter
 
+import numpy as np
 from tqdm import tqdm
-import matplotlib.pyplot as plt
 
 def histogram(x, title='', xlabel='Features', ylabel='Frequency'):
+    import matplotlib.pyplot as plt
     freq = Counter(sorted(x))
     plt.figure(figsize=(18,8))
     plt.bar(freq.keys(), freq.values(), align='center', color='#3c3c3c', alpha=0.5)
@@ -14,15 +17,93 @@ def histogram(x, title='', xlabel='Features', ylabel='Frequency'):
     plt.show()
 
 
-def get(fp):
-    """Basic csv loader which separates the columns (i.e. features) into a dict."""
-    with open(fp, newline='', encoding='utf8') as file:
-        total = sum(1 for line in open(fp, encoding='utf8'))
-        reader = csv.reader(file, delimiter=',')
+class Categorical:
+    """
+    Dictionary-encoded column: the i-th value is categories[codes[i]]. It behaves like the list
+    of values it replaces (len, indexing, iteration) while only storing one int32 per row.
+
+    Example:
+    ---
+        column = Categorical(np.array([0, 1, 0]), np.array(['a', 'b'], dtype=object))
+        list(column) # returns ['a', 'b', 'a']
+    """
+
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __getitem__(self, i):
+        return self.categories[self.codes[i]]
+
+    def __iter__(self):
+        return iter(self.categories[self.codes])
+
+    def __len__(self):
+        return len(self.codes)
+
+
+def get(fp, columns=None, categorical=(), chunk_size=1 << 16):
+    """
+    get(fp, columns=None, categorical=(), chunk_size=65536) --> (headers, data)
+
+    Description
+    ---
+    Csv loader which separates the columns (i.e. features) into a dict of numpy arrays. The
+    file is read once, by chunks of rows, and only the requested columns are kept.
+
+    Parameters
+    ---
+    fp: string
+        Path to the csv file.
+    columns: list of string
+        The columns to extract, all of them by default.
+    categorical: list of string
+        The columns to dictionary-encode into a Categorical, the others are object arrays.
+    chunk_size: int
+        Number of rows parsed at once, it bounds the size of the intermediate Python lists.
+
+    Returns
+    ---
+        (headers, data)
+
+    headers: list of string
+        The names of the extracted columns.
+    data: dict {header: np.ndarray or Categorical}
+    """
+    with open(fp, 'rb') as file:
+        read = [0]
+        def lines():
+            for line in file:
+                read[0] += len(line)
+                yield line.decode('utf8')
+
+        reader = filter(None, csv.reader(lines(), delimiter=',')) # skips blank lines
         headers = next(reader, None)
-        data = {h: [] for h in headers}
+        columns = headers if columns is None else list(columns)
+        positions = [headers.index(h) for h in columns]
+        getter = itemgetter(*positions) if len(positions) > 1 else lambda row: (row[positions[0]],)
+
+        vocabs = {h: {} for h in columns if h in categorical}
+        chunks = {h: [] for h in columns}
         print('Loading %s' % fp)
-        for row in tqdm(reader, total=total):
-            for h, v in zip(headers, row):
-                data[h].append(v)
-    return headers, data
+        with tqdm(total=os.path.getsize(fp), unit='B', unit_scale=True) as t:
+            while rows := list(map(getter, islice(reader, chunk_size))):
+                for h, values in zip(columns, zip(*rows)):
+                    if h in vocabs:
+                        vocab = vocabs[h]
+                        chunks[h].append(np.fromiter((vocab.setdefault(v, len(vocab))
+                            for v in values), dtype=np.int32, count=len(values)))
+                    else:
+                        chunks[h].append(np.array(values, dtype=object))
+                t.update(read[0] - t.n)
+
+    data = {}
+    for h in columns:
+        values = np.concatenate(chunks.pop(h)) if chunks[h] else \
+            np.empty(0, dtype=np.int32 if h in vocabs else object)
+        if h in vocabs:
+            categories = np.empty(len(vocabs[h]), dtype=object)
+            categories[:] = list(vocabs.pop(h))
+            values = Categorical(values, categories)
+        data[h] = values
+    return columns, data
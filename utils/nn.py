@@ -1,12 +1,87 @@
+import math
+from typing import NamedTuple
+
+import numpy as np
+import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence
+
+class Bags(NamedTuple):
+    """
+    Batch of sparse encodings laid out the way nn.EmbeddingBag expects them: the flattened
+    non-zero indices and their weights, the offset at which each bag starts, and the shape the
+    bags are arranged in (e.g. (batch,) or (seq, batch)).
+    """
+    indices: torch.Tensor
+    offsets: torch.Tensor
+    weights: torch.Tensor
+    shape: tuple
+
+    @classmethod
+    def from_sparse(cls, encodings, shape):
+        """Builds the bags from a flat list of (indices, weights) pairs, as returned by `sparse`."""
+        lengths = [len(i) for i, _ in encodings]
+        offsets = np.zeros(len(encodings), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        return cls(torch.from_numpy(np.concatenate([i for i, _ in encodings]).astype(np.int64)),
+            torch.from_numpy(offsets),
+            torch.from_numpy(np.concatenate([w for _, w in encodings]).astype(np.float32)),
+            tuple(shape))
+
+    @classmethod
+    def cat(cls, bags):
+        """Concatenates several Bags into a flat one, of shape (total number of bags,)."""
+        nnz = np.cumsum([0] + [len(b.indices) for b in bags[:-1]])
+        return cls(torch.cat([b.indices for b in bags]),
+            torch.cat([b.offsets + n for b, n in zip(bags, nnz.tolist())]),
+            torch.cat([b.weights for b in bags]),
+            (sum(math.prod(b.shape) for b in bags),))
+
+
+class Indexed(NamedTuple):
+    """
+    Songs of a batch referenced through a table of the unique songs of the batch: `songs` holds
+    their encodings, a (n_unique, song_mhe) tensor or Bags of shape (n_unique,), and `index` the
+    row of `songs` at each position, e.g. a (seq, batch) playlist or (batch, subset) candidates.
+    """
+    songs: object
+    index: torch.Tensor
+
+    @property
+    def shape(self):
+        return self.index.shape
+
+
+class SparseLinear(nn.Module):
+    """Linear layer for sparse inputs: sums the weighted columns of the non-zero features only."""
+
+    def __init__(self, n_in, n_out):
+        super(SparseLinear, self).__init__()
+        self.bag = nn.EmbeddingBag(n_in, n_out, mode='sum')
+        self.bias = nn.Parameter(torch.empty(n_out))
+        bound = 1/math.sqrt(n_in) # same initialization as nn.Linear
+        nn.init.uniform_(self.bag.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, X):
+        return self.bag(X.indices, X.offsets, per_sample_weights=X.weights) + self.bias
+
+    def to_dense(self):
+        """Returns the equivalent nn.Linear, taking dense inputs."""
+        linear = nn.Linear(*self.bag.weight.shape)
+        with torch.no_grad():
+            linear.weight.copy_(self.bag.weight.t())
+            linear.bias.copy_(self.bias)
+        return linear
+
 
 class MLP(nn.Module):
-    """Three-layer perceptron with ReLUs."""
+    """Three-layer perceptron with ReLUs, the first layer can take sparse inputs (i.e. Bags)."""
 
-    def __init__(self, n_in, n_1, n_2, n_out):
+    def __init__(self, n_in, n_1, n_2, n_out, sparse=False):
         super(MLP, self).__init__()
+        self.input = SparseLinear(n_in, n_1) if sparse else nn.Linear(n_in, n_1)
         self.body = nn.Sequential(
-            nn.Linear(n_in, n_1),
             nn.ReLU(),
             nn.Linear(n_1, n_2),
             nn.ReLU(),
@@ -15,7 +90,9 @@ class MLP(nn.Module):
         )
 
     def forward(self, X):
-        return self.body(X)
+        if isinstance(X, Bags):
+            return self.body(self.input(X)).view(*X.shape, -1)
+        return self.body(self.input(X))
 
 
 class RNN(nn.Module):
@@ -31,6 +108,17 @@ class RNN(nn.Module):
             nn.ReLU()
         )
 
-    def forward(self, X):
-        X, _ = self.lstm(X)
-        return self.body(X[-1])
+    def forward(self, X, lengths=None):
+        """
+        X is either a (seq, batch, n_in) tensor, a PackedSequence, or a right-padded tensor
+        along with the size of each sequence in lengths. The latter is packed so that padding
+        steps are skipped. The output is computed on the last state of each sequence.
+        """
+        hx = None
+        if lengths is not None:
+            # Explicit initial state: its size follows the batch in traced models (see export.py).
+            zeros = X.new_zeros(self.lstm.num_layers, lengths.shape[0], self.lstm.hidden_size)
+            hx = (zeros, zeros)
+            X = pack_padded_sequence(X, lengths.cpu(), enforce_sorted=False)
+        _, (h, _) = self.lstm(X, hx)
+        return self.body(h[-1]) # h is in the original batch order, even when packed unsorted
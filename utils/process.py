@@ -1,28 +1,53 @@
 import re
 
-def process(data, ids, mapping, transform, policy):
+import numpy as np
+
+from utils.misc import Categorical
+
+SPACE = re.compile(r'\s')
+CJK = re.compile('[\u4e00-\u9FFF]|[\u3040-\u30ff]|[\uac00-\ud7a3]|[\u0E00-\u0E7F]')
+
+
+def factorize(data):
+    """
+    Returns (codes, categories) such that data[i] == categories[codes[i]], categories being in
+    order of first appearance. A utils.misc.Categorical is returned as is.
     """
-    process(data, ids, mapping transform, policy) --> (result, result_set)
+    if isinstance(data, Categorical):
+        return np.asarray(data.codes), data.categories
+    index = {}
+    codes = np.fromiter((index.setdefault(x, len(index)) for x in data), np.int64, len(data))
+    categories = np.empty(len(index), dtype=object)
+    categories[:] = list(index)
+    return codes, categories
+
+def process(data, ids, alive, transform, policy):
+    """
+    process(data, ids, alive, transform, policy) --> (result, result_set)
 
     Description
     ---
     Processing pipeline to transform feature values presented by data, filter the invalid
-    ones and keep track these in a dict. Summary of the operation:
+    ones and keep track these in a boolean array. Summary of the operation:
 
-        data ──── [transform] ──── [policy] ──── mapping
+        data ──── [transform] ──── [policy] ──── alive
                         └──── result    └──── result_set
 
+    Rows sharing the same value are processed together: transform and policy are only called
+    once per distinct value of data, the rows are then handled as arrays. Values of rows
+    already discarded are not transformed at all.
+
     Parameters
     ---
-    data : list of string
+    data : list of string or utils.misc.Categorical
         The input array, it represent the values of a single feature. Each element in the list
         represent the feature value as a string. Data points can have more than one feature
         value, in this case they are separated by a pipe sign.
-    ids: list
-        The array of ids, it allows to find the identifier of a data point given its index.
-    mapping: dict {id: index}
-        Somewhat the opposite of ids. Difference being that it is used to keep track of the
-        data points that are discarded. These are tagged by setting their indices to -1.
+    ids: np.ndarray of int
+        The code of the identifier of each data point, see factorize.
+    alive: np.ndarray of bool
+        Indexed by identifier code, it is used to keep track of the data points that are
+        discarded. These are tagged by setting their entry to False (updated in place).
     transform: function(string) -> any
         The transformation to apply to the input list.
     policy: function(any) -> bool
@@ -33,22 +58,38 @@ def process(data, ids, mapping, transform, policy):
     ---
         (result, result_set)
 
-    result: list of a list of feature values
+    result: utils.misc.Categorical of lists of feature values
         The input list mapped with the transform function. It has the same size as the input
         list, even if some points have been invalidated by policy. This is done in order to
-        keep consistency of the indices accross all feature lists.
+        keep consistency of the indices accross all feature lists. Rows of the same value
+        share the same list, rows discarded by a previous feature are None.
     result_set: set of feature
         Will appear in this set only the feature values that have been validated by policy.
     """
-    result, result_set  = [], set()
-    for i, x in enumerate(data):
-        x = list(map(transform, x.split('|')))
-        result.insert(i, x)
-        if mapping[ids[i]] != -1 and all(map(policy, x)):
-            result_set.update(x)
-        else:
-            mapping[ids[i]] = -1
-    return result, result_set
+    codes, categories = factorize(data)
+
+    # Values only appearing in rows already discarded are left untransformed (None).
+    needed = np.zeros(len(categories), dtype=bool)
+    needed[codes[alive[ids]]] = True
+    needed = np.flatnonzero(needed)
+    transformed = np.fromiter((list(map(transform, x.split('|')))
+        for x in categories[needed].tolist()), dtype=object, count=len(needed))
+    values, valid = np.empty(len(categories), dtype=object), np.zeros(len(categories), dtype=bool)
+    values[needed] = transformed
+    valid[needed] = np.fromiter((all(map(policy, x)) for x in transformed), bool, len(needed))
+    valid = valid[codes]
+
+    # A row is kept if its identifier is alive and if no previous row of the same identifier
+    # was invalidated, as when the rows are processed one after the other.
+    first_invalid = np.full(len(alive), len(codes))
+    np.minimum.at(first_invalid, ids[~valid], np.flatnonzero(~valid))
+    kept = valid & alive[ids] & (np.arange(len(codes)) < first_invalid[ids])
+
+    result_set = set()
+    for x in values[np.unique(codes[kept])]:
+        result_set.update(x)
+    alive[ids[~valid]] = False
+    return Categorical(codes, values), result_set
 
 def no_special_character(x):
     """
@@ -57,5 +98,4 @@ def no_special_character(x):
         * is no longer than 25 characters;
         * doesn't contain spaces.
     """
-    return re.search('\s', x) and not(len(x) > 25
-        or re.search("[\u4e00-\u9FFF]|[\u3040-\u30ff]|[\uac00-\ud7a3]|[\u0E00-\u0E7F]", x))
+    return SPACE.search(x) and not(len(x) > 25 or CJK.search(x))
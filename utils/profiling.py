@@ -0,0 +1,180 @@
+import csv, json, os, resource, time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+"""
+Opt-in instrumentation of the training loop (see model.DTNMRWrapper): per-step timings of each
+stage, throughput, peak memory and DataLoader queue depth, written as CSV or JSONL, and a window
+of steps recorded by torch.profiler and exported as a Chrome trace (chrome://tracing or
+https://ui.perfetto.dev). Timings are wall-clock, which is exact on CPU where every op is
+synchronous. When instrumentation is disabled the training loop doesn't call any of it.
+"""
+
+STAGES = ('data', 'collate', 'forward', 'backward', 'step')
+FIELDS = ('epoch', 'step', *(stage + '_ms' for stage in STAGES), 'total_ms', 'samples',
+    'samples_per_s', 'max_rss_mb', 'queue_depth', 'loss')
+
+class TimedCollate:
+    """
+    Wraps a collate_fn so that it returns (batch, seconds spent collating). It is run by the
+    DataLoader workers: the duration travels along with the batch to the training process.
+    """
+
+    def __init__(self, collate):
+        self.collate = collate
+
+    def __call__(self, batch):
+        start = time.perf_counter()
+        batch = self.collate(batch)
+        return batch, time.perf_counter() - start
+
+
+def queue_depth(iterator):
+    """
+    Number of batches loaded by the workers and waiting to be consumed, None without workers
+    or on platforms where queues can't be sized.
+    """
+    queue = getattr(iterator, '_data_queue', None)
+    try:
+        return queue.qsize() if queue is not None else None
+    except NotImplementedError:
+        return None
+
+
+class StepProfiler:
+    """
+    Records the duration of each stage of the training steps:
+        data: time spent waiting for the next batch, minus the collate time when the batches
+            are loaded in the main process
+        collate: time spent collating the batch, in a worker or in the main process, only
+            known when the DataLoader's collate_fn is a TimedCollate
+        forward, backward, step: the forward pass and loss, the backward pass (gradients
+            all-reduce included in distributed training) and the optimizer step
+    along with the points per second, the peak resident memory of the process and the
+    number of batches waiting in the DataLoader queue.
+    """
+
+    def __init__(self, fp=None, trace_dir=None, profile_start=0, profile_steps=0, rank=0,
+        world_size=1):
+        """
+        Parameters
+        ---
+        fp: string
+            File where one row per step is written, as JSON lines if it ends with .jsonl and
+            as CSV otherwise. In distributed training each rank writes its own file, suffixed
+            with its rank. Nothing is written by default, stages are still summarized.
+        trace_dir: string
+            Directory where the Chrome trace of the profiled steps is written.
+        profile_start, profile_steps: int
+            Window of steps, counted from the start of the run, recorded by torch.profiler.
+            No step is profiled by default.
+        """
+        self.trace_dir = trace_dir
+        self.window = (profile_start, profile_start + profile_steps)
+        self.rank = rank
+        self.profiler = None
+        self.steps = 0 # steps run by this process
+        self.current = None
+        self.totals = dict.fromkeys(FIELDS[2:9], 0.) # stage and total durations, samples
+        self.counted = 0
+
+        self.file = self.writer = None
+        if fp:
+            if world_size > 1:
+                root, ext = os.path.splitext(fp)
+                fp = '{}.rank{}{}'.format(root, rank, ext)
+            os.makedirs(os.path.dirname(fp) or '.', exist_ok=True)
+            self.file = open(fp, 'w', newline='')
+            if not fp.endswith('.jsonl'):
+                self.writer = csv.DictWriter(self.file, FIELDS)
+                self.writer.writeheader()
+
+    def iterate(self, loader, epoch=0):
+        """Iterates over the batches of the DataLoader, timing the wait for each of them."""
+        self.totals = dict.fromkeys(self.totals, 0.)
+        self.counted = 0
+        timed = isinstance(loader.collate_fn, TimedCollate)
+        iterator = iter(loader)
+        while True:
+            if self.steps == self.window[0] and self.window[1] > self.window[0]:
+                self.start_trace()
+            start = time.perf_counter()
+            try:
+                with self.record('data'):
+                    batch = next(iterator)
+            except StopIteration:
+                return
+            data = time.perf_counter() - start
+            collate = None
+            if timed:
+                batch, collate = batch
+                if loader.num_workers == 0:
+                    data -= collate
+            self.current = {'epoch': epoch, 'step': self.steps, 'data_ms': data * 1000,
+                'collate_ms': collate * 1000 if collate is not None else None,
+                'queue_depth': queue_depth(iterator), 'start': start}
+            yield batch
+
+    @contextmanager
+    def stage(self, name):
+        """Times a stage of the current step, labelled in the trace when profiled."""
+        start = time.perf_counter()
+        with self.record(name):
+            yield
+        self.current[name + '_ms'] = (time.perf_counter() - start) * 1000
+
+    def record(self, name):
+        if self.profiler is None:
+            return nullcontext()
+        return torch.profiler.record_function(name)
+
+    def end_step(self, samples, loss=None):
+        """Closes the current step, of `samples` points, and writes its row."""
+        row = self.current
+        total = time.perf_counter() - row.pop('start')
+        row.update(total_ms=total * 1000, samples=samples, samples_per_s=samples / total,
+            max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, loss=loss)
+        for key in self.totals:
+            self.totals[key] += row.get(key) or 0
+        self.counted += 1
+        if self.writer is not None:
+            self.writer.writerow(row)
+        elif self.file is not None:
+            self.file.write(json.dumps(row) + '\n')
+
+        self.steps += 1
+        if self.profiler is not None and self.steps == self.window[1]:
+            self.stop_trace()
+
+    def summary(self):
+        """Mean duration (ms) of each stage over the steps of the epoch, and its throughput."""
+        summary = {key: value / max(self.counted, 1) for key, value in self.totals.items()
+            if key.endswith('_ms')}
+        summary['samples_per_s'] = self.totals['samples'] / max(self.totals['total_ms'], 1e-9) \
+            * 1000
+        return summary
+
+    def start_trace(self):
+        self.profiler = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True,
+            profile_memory=True, with_stack=False)
+        self.profiler.__enter__()
+
+    def stop_trace(self):
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(self.trace_dir or '.', exist_ok=True)
+        first, last = self.window[0], self.window[1] - 1
+        fp = os.path.join(self.trace_dir or '.', 'trace.rank{}.steps{}-{}.json'.format(
+            self.rank, first, last))
+        self.profiler.export_chrome_trace(fp)
+        self.profiler = None
+        print('trace of steps {} to {} written to {}'.format(first, last, fp))
+
+    def close(self):
+        if self.profiler is not None: # the run ended within the window
+            self.window = (self.window[0], self.steps)
+            self.stop_trace()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,116 @@
+import numpy as np
+
+class AliasTable:
+    """
+    Walker's alias method: after an O(n) construction, draws from a discrete distribution over
+    n outcomes in O(1) per sample, two uniform draws each.
+
+    Example:
+    ---
+        table = AliasTable([10, 1, 1])
+        table.sample(np.random.default_rng(0), 5) # array of outcomes, mostly 0s
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        assert weights.sum() > 0, 'the weights must have a positive sum'
+        prob = weights * n / weights.sum()
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = list(np.flatnonzero(prob < 1))
+        large = list(np.flatnonzero(prob >= 1))
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = prob[s], l
+            prob[l] -= 1 - prob[s]
+            (small if prob[l] < 1 else large).append(l)
+
+    def sample(self, rng, size):
+        outcomes = rng.integers(0, len(self.prob), size)
+        return np.where(rng.random(size) < self.prob[outcomes], outcomes, self.alias[outcomes])
+
+
+class NegativeSampler:
+    """
+    Draws the negative songs of a whole batch at once.
+
+    Modes
+    ---
+        uniform: songs are drawn uniformly from the catalogue.
+        popularity: songs are drawn proportionally to their number of plays (AliasTable).
+        in-batch: the negatives of a point are the labels of the other points of the batch,
+            topped up with uniform draws when the batch is too small.
+
+    The label of a point is never one of its negatives and, with exclude_history, neither are
+    the songs of its known playlist: such draws are redrawn from the base distribution, then
+    uniformly among the valid songs after max_redraws attempts (e.g. a head song drawn again and
+    again by popularity). A ValueError is raised when a point has no valid song at all.
+    """
+
+    def __init__(self, n_songs, mode='uniform', popularity=None, exclude_history=False,
+        seed=None, max_redraws=10):
+        assert mode in ('uniform', 'popularity', 'in-batch'), 'unknown mode %s' % mode
+        self.n_songs = n_songs
+        self.mode = mode
+        self.alias = AliasTable(popularity) if mode == 'popularity' else None
+        self.exclude_history = exclude_history
+        self.max_redraws = max_redraws
+        self.seed(seed)
+
+    def seed(self, seed):
+        """Resets the random generator, e.g. with a different seed in each DataLoader worker."""
+        self.rng = np.random.default_rng(seed)
+
+    def draw(self, size):
+        """Draws songs from the base distribution."""
+        if self.alias is not None:
+            return self.alias.sample(self.rng, size)
+        return self.rng.integers(0, self.n_songs, size)
+
+    def __call__(self, labels, n, histories=None):
+        """
+        Returns a (len(labels), n) array of negative song rows.
+
+        Parameters
+        ---
+        labels: np.ndarray
+            The song row of the label of each point.
+        n: int
+            Number of negatives per point.
+        histories: list of np.ndarray
+            The song rows of the known playlist of each point, used with exclude_history.
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        batch_size = len(labels)
+        if self.mode == 'in-batch' and batch_size > 1:
+            others = (np.arange(batch_size)[:, None] + np.arange(1, batch_size)) % batch_size
+            negatives = self.rng.permuted(labels[others], axis=1)[:, :n]
+            if negatives.shape[1] < n:
+                negatives = np.hstack([negatives, self.draw((batch_size, n - negatives.shape[1]))])
+        else:
+            negatives = self.draw((batch_size, n))
+
+        # Keys (point, song) of the songs each point must not be given.
+        excluded = labels + np.arange(batch_size) * self.n_songs
+        if self.exclude_history and histories is not None:
+            excluded = np.concatenate([excluded] + [np.asarray(h, dtype=np.int64)
+                + i * self.n_songs for i, h in enumerate(histories)])
+        offsets = np.arange(batch_size)[:, None] * self.n_songs
+
+        for _ in range(self.max_redraws):
+            invalid = np.isin(negatives + offsets, excluded)
+            if not invalid.any():
+                return negatives
+            negatives[invalid] = self.draw(int(invalid.sum()))
+
+        # The draws still invalid are drawn uniformly among the songs their point may be given.
+        invalid = np.isin(negatives + offsets, excluded)
+        for i in np.flatnonzero(invalid.any(axis=1)):
+            allowed = np.setdiff1d(np.arange(self.n_songs), excluded[excluded // self.n_songs == i]
+                - i * self.n_songs)
+            if not len(allowed):
+                raise ValueError('no valid negative for point {}: its label and excluded history '
+                    'cover the {} songs of the catalogue'.format(i, self.n_songs))
+            negatives[i, invalid[i]] = self.rng.choice(allowed, int(invalid[i].sum()))
+        return negatives
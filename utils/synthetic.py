@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+
+"""
+Synthetic data in the format of the WSDM-KKBOX csv files, of any size, e.g. for benchmarks
+(see bench.py) without the real files. Song popularity follows a Zipf law and playlist lengths
+a geometric law, feature vocabularies grow with the number of songs and users.
+"""
+
+BEHAVIORS = np.array(['my library', 'discover', 'search', 'radio', 'listen with', 'explore',
+    'notification', 'settings', 'null'])
+BEHAVIOR_WEIGHTS = np.array([50, 20, 10, 8, 5, 3, 2, 1, 1]) / 100
+LANGUAGES = np.array(['3', '52', '-1', '17', '31', '10', '24', '59', '45', '38'])
+
+def write_csv(fp, header, columns):
+    with open(fp, 'w', encoding='utf8') as f:
+        f.write(','.join(header) + '\n')
+        f.writelines(','.join(row) + '\n' for row in zip(*columns))
+
+def ids(prefix, n):
+    return np.array(['{}{:07d}'.format(prefix, i) for i in range(n)], dtype=object)
+
+def zipf(rng, n, size, exponent=0.8):
+    """Draws size integers in [0, n) with probabilities proportional to 1 / (i + 1)^exponent."""
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return rng.choice(n, size, p=weights / weights.sum())
+
+def generate(fp, n_users=2000, n_songs=20000, playlist_len=50, test_ratio=0.2, seed=0):
+    """
+    Writes train.csv, test.csv, songs.csv and members.csv into directory fp.
+
+    Parameters
+    ---
+    n_users, n_songs: int
+        Number of members and of songs of the catalogue.
+    playlist_len: int
+        Mean number of distinct songs listened to per user.
+    test_ratio: float
+        Fraction of the records written to test.csv rather than train.csv.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(fp, exist_ok=True)
+    users, songs = ids('u', n_users), ids('s', n_songs)
+
+    # Songs, a few are too long or have invalid artists and are filtered out by the processing.
+    artists = np.array(['Artist {}'.format(i) for i in range(max(1, n_songs // 10))], dtype=object)
+    genres = np.array([str(100 + i) for i in range(max(2, n_songs // 500))], dtype=object)
+    lengths = np.clip(rng.lognormal(np.log(240000), 0.3, n_songs), 30000, 600000).astype(int)
+    first, second = rng.integers(0, len(genres), (2, n_songs))
+    two = rng.random(n_songs) < 0.2
+    genre_ids = np.where(two, genres[first] + '|' + genres[second], genres[first])
+    write_csv(os.path.join(fp, 'songs.csv'),
+        ('song_id', 'song_len', 'genre_ids', 'artist_name', 'composer', 'lyricist', 'language'),
+        (songs, lengths.astype(str), genre_ids, artists[zipf(rng, len(artists), n_songs)],
+            artists[zipf(rng, len(artists), n_songs)], np.full(n_songs, ''),
+            LANGUAGES[zipf(rng, len(LANGUAGES), n_songs, 1.5)]))
+
+    # Members, some have no valid age and are filtered out.
+    write_csv(os.path.join(fp, 'members.csv'), ('msno', 'city', 'bd', 'gender', 'registered_via'),
+        (users, rng.integers(1, 22, n_users).astype(str),
+            np.where(rng.random(n_users) < 0.9, rng.integers(16, 60, n_users), 0).astype(str),
+            rng.choice(['male', 'female', ''], n_users, p=[0.45, 0.45, 0.1]),
+            np.full(n_users, '7')))
+
+    # Records: distinct (user, song) pairs in time order, split at random between the files.
+    counts = np.minimum(rng.geometric(1 / playlist_len, n_users), n_songs)
+    user_rows = np.repeat(np.arange(n_users), counts)
+    song_rows = zipf(rng, n_songs, len(user_rows))
+    _, first_pairs = np.unique(user_rows * n_songs + song_rows, return_index=True)
+    first_pairs.sort()
+    user_rows, song_rows = user_rows[first_pairs], song_rows[first_pairs]
+    behaviors = BEHAVIORS[rng.choice(len(BEHAVIORS), len(user_rows), p=BEHAVIOR_WEIGHTS)]
+    test = rng.random(len(user_rows)) < test_ratio
+    for name, rows in (('train.csv', ~test), ('test.csv', test)):
+        n = int(rows.sum())
+        write_csv(os.path.join(fp, name), ('msno', 'song_id', 'source_system_tab',
+            'source_screen_name', 'source_type', 'target'),
+            (users[user_rows[rows]], songs[song_rows[rows]], behaviors[rows],
+                np.full(n, 'Local playlist more'), np.full(n, 'local-library'), np.full(n, '1')))
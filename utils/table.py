@@ -0,0 +1,121 @@
+import os, json, shutil
+
+import numpy as np
+
+class EncodingTable:
+    """
+    Read-only table of precomputed sparse encodings, stored on disk in CSR form. The i-th row is
+    the encoding of the entity ids[i]: its non-zero bits are indices[indptr[i]:indptr[i+1]] and
+    their values weights[indptr[i]:indptr[i+1]]. Arrays are memory-mapped (np.memmap) so that
+    DataLoader worker processes all read the same pages instead of each holding a copy.
+
+    Example:
+    ---
+        EncodingTable.build('data/songs.table', songs.keys(),
+            lambda id: encode_song.sparse(*songs[id]), width=len(encode_song))
+        table = EncodingTable('data/songs.table')
+        table.dense(table.index[song_id]) # same as encode_song(*songs[song_id])
+    """
+
+    def __init__(self, fp):
+        if not os.path.isdir(fp):
+            raise FileNotFoundError(fp)
+        with open(os.path.join(fp, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.width = self.meta['width']
+        self.ids = np.load(os.path.join(fp, 'ids.npy'))
+        self.indptr = np.load(os.path.join(fp, 'indptr.npy'), mmap_mode='r')
+        self.indices = np.load(os.path.join(fp, 'indices.npy'), mmap_mode='r')
+        self.weights = np.load(os.path.join(fp, 'weights.npy'), mmap_mode='r')
+        self.index = {id: i for i, id in enumerate(self.ids.tolist())}
+
+    @staticmethod
+    def build(fp, ids, encode, width, **meta):
+        """
+        Encodes every entity once and dumps the table into directory fp. Keyword arguments are
+        saved in meta.json, e.g. the parameters the encoding depends on.
+
+        Parameters
+        ---
+        ids: iterable of string
+            The entity identifiers, their order defines the dense row index.
+        encode: function(id) -> (indices, weights)
+            The sparse encoding function, see utils.encoders.Encoder.sparse.
+        width: int
+            Size of the dense encoding.
+        """
+        ids = list(ids)
+        indptr, indices, weights = EncodingTable.encode(ids, encode)
+        EncodingTable.write(fp, np.array(ids, dtype=str), indptr, indices, weights, width, **meta)
+
+    @staticmethod
+    def append(fp, ids, encode):
+        """Appends the encodings of new entities at the end of the table saved in fp."""
+        table = EncodingTable(fp)
+        ids = list(ids)
+        indptr, indices, weights = EncodingTable.encode(ids, encode)
+        EncodingTable.write(fp, np.concatenate([table.ids, np.array(ids, dtype=str)]),
+            np.concatenate([table.indptr, table.indptr[-1] + indptr[1:]]),
+            np.concatenate([table.indices, indices]), np.concatenate([table.weights, weights]),
+            **table.meta)
+
+    @staticmethod
+    def encode(ids, encode):
+        """Encodes the entities into (indptr, indices, weights) CSR arrays."""
+        indptr, indices, weights = np.zeros(len(ids) + 1, dtype=np.int64), [], []
+        for i, id in enumerate(ids):
+            idx, w = encode(id)
+            indices.append(np.asarray(idx, dtype=np.int32))
+            weights.append(np.asarray(w, dtype=np.float32))
+            indptr[i+1] = indptr[i] + len(idx)
+        return (indptr, np.concatenate(indices + [np.empty(0, np.int32)]),
+            np.concatenate(weights + [np.empty(0, np.float32)]))
+
+    @staticmethod
+    def write(fp, ids, indptr, indices, weights, width, rows=None, **meta):
+        """Writes the table into directory fp, replacing it at once when complete."""
+        tmp = fp + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'ids.npy'), ids)
+        np.save(os.path.join(tmp, 'indptr.npy'), indptr)
+        np.save(os.path.join(tmp, 'indices.npy'), indices)
+        np.save(os.path.join(tmp, 'weights.npy'), weights)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'width': width, 'rows': len(ids), **meta}, f)
+        shutil.rmtree(fp, ignore_errors=True)
+        os.replace(tmp, fp)
+
+    def sparse(self, i):
+        """Returns the (indices, weights) pair of row i."""
+        start, end = self.indptr[i], self.indptr[i+1]
+        return self.indices[start:end].astype(np.int64), np.array(self.weights[start:end])
+
+    def dense(self, i):
+        """Returns row i as a dense float32 vector."""
+        start, end = self.indptr[i], self.indptr[i+1]
+        row = np.zeros(self.width, dtype=np.float32)
+        row[self.indices[start:end]] = self.weights[start:end]
+        return row
+
+    def gather(self, rows):
+        """
+        Returns the rows at once in CSR form: (indices, offsets, weights) where the non-zero
+        bits of rows[i] are indices[offsets[i]:offsets[i+1]].
+        """
+        rows = np.asarray(rows)
+        starts, counts = self.indptr[rows], self.indptr[rows + 1] - self.indptr[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        return self.indices[positions].astype(np.int64), offsets, self.weights[positions]
+
+    def dense_rows(self, rows):
+        """Returns the rows at once as a dense (len(rows), width) float32 array."""
+        indices, offsets, weights = self.gather(rows)
+        dense = np.zeros((len(offsets) - 1, self.width), dtype=np.float32)
+        dense[np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)), indices] = weights
+        return dense
+
+    def __len__(self):
+        return len(self.indptr) - 1